@@ -2,6 +2,10 @@
 # -*- coding: utf-8 -*-
 
 from .algorithm import tone_mapping
+from .mapper import ToneMapper, HistogramModel, tone_mapping_batch
+from .mapper import kernel_sweep
+from .planner import memory_plan
+from .profiling import Profiler
 from .tools import eprint, dither
 
 __version__ = '1.0.1'
@@ -38,5 +42,11 @@ Zenodo. https://doi.org/"""
 
 tone_mapping = tone_mapping
 TMO = tone_mapping
+ToneMapper = ToneMapper
+HistogramModel = HistogramModel
+tone_mapping_batch = tone_mapping_batch
+kernel_sweep = kernel_sweep
+memory_plan = memory_plan
+Profiler = Profiler
 eprint = eprint
 dither = dither
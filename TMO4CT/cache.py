@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+from collections import OrderedDict
+from hashlib import sha1
+from tempfile import mkstemp
+import numpy as np
+
+
+class KernelCache(object):
+    """
+    In-memory LRU cache for kernel spectra, bounded by the total size
+    of the stored arrays, and optionally backed by a directory of .npy
+    files, so the kernels survive between runs.
+
+    >>> if True:
+    ...     cache = KernelCache(max_bytes=100)
+    ...     a = cache.get(('a', 1), lambda: np.zeros(10))
+    ...     b = cache.get(('a', 1), lambda: np.ones(10))
+    ...     print(a is b, cache.hits, cache.misses)
+    True 1 1
+
+    The least recently used entries are dropped if the size limit
+    is exceeded:
+
+    >>> if True:
+    ...     c = cache.get(('c',), lambda: np.zeros(10))
+    ...     print(len(cache), cache.nbytes)
+    ...     a = cache.get(('a', 1), lambda: np.ones(10))
+    ...     print(a[0], cache.hits, cache.misses)
+    1 80
+    1.0 1 3
+
+    >>> if True:
+    ...     import tempfile
+    ...     d = tempfile.mkdtemp()
+    ...     a = KernelCache(cache_dir=d).get('key', lambda: np.arange(3))
+    ...     cache = KernelCache(cache_dir=d)
+    ...     b = cache.get('key', lambda: np.zeros(3))
+    ...     print(b, cache.hits, cache.disk_hits, cache.misses)
+    ...     cache.clear(disk=True)
+    ...     print(os.listdir(d))
+    [0 1 2] 1 1 0
+    []
+    """
+
+    def __init__(self, max_bytes=512 * 2**20, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self):
+        return sum(v.nbytes for v in self._entries.values())
+
+    @staticmethod
+    def name(key):
+        return sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, name + '.npy')
+
+    def _load(self, name):
+        if self.cache_dir is None:
+            return None
+        try:
+            return np.load(self._path(name))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _save(self, name, value):
+        if self.cache_dir is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # write-and-rename, concurrent processes may share the directory
+        fd, fn = mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, value)
+        os.replace(fn, self._path(name))
+
+    def get(self, key, factory):
+        name = self.name(key)
+        if name in self._entries:
+            self._entries.move_to_end(name)
+            self.hits += 1
+            return self._entries[name]
+
+        value = self._load(name)
+        if value is not None:
+            self.hits += 1
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            value = factory()
+            self._save(name, value)
+
+        # cached arrays are shared between calls
+        value.setflags(write=False)
+        self._entries[name] = value
+        while len(self._entries) > 1 and self.nbytes > self.max_bytes:
+            self._entries.popitem(last=False)
+        if self.nbytes > self.max_bytes:
+            self._entries.clear()
+        return value
+
+    def clear(self, disk=False):
+        self._entries.clear()
+        if disk and self.cache_dir is not None:
+            for fn in os.listdir(self.cache_dir):
+                if fn.endswith('.npy'):
+                    os.remove(os.path.join(self.cache_dir, fn))
+
+    def stats(self):
+        return {'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'entries': len(self),
+                'nbytes': self.nbytes}
+
+
+kernel_cache = KernelCache()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
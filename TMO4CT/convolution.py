@@ -0,0 +1,492 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import scipy.fft
+from .tools import jit
+
+
+def fft_shape(shape):
+    """
+    Size of the reflect-padded layers (half of the layer size on
+    each side), rounded up to FFT-friendly sizes.
+
+    >>> fft_shape((100, 37))
+    (200, 75)
+    """
+    return tuple(scipy.fft.next_fast_len(n + 2 * (n // 2), real=True)
+                 for n in shape)
+
+
+def batch_size(shape, batch_bytes=2**26):
+    """
+    Number of layers of the given shape in a batch, so the padded
+    double precision batch is about 'batch_bytes'.
+
+    >>> batch_size((256, 256))
+    32
+    """
+    return max(1, batch_bytes // (int(np.prod(fft_shape(shape))) * 8))
+
+
+def fft_conv(layers, fmask, workers=1, out=None):
+    """
+    Convolution of a batch of layers (along the first axis) with the
+    kernel spectrum 'fmask', with reflective boundaries.
+
+    The layers are reflect-padded by half of their size, then padded
+    further to the FFT-friendly fft_shape(). The kernel never reaches
+    beyond the first reflection, so the extra padding does not change
+    the result. The transforms of the whole batch are distributed
+    over 'workers' threads. 'out' can be the input itself.
+    The precision of the transforms follows the kernel spectrum:
+    with a complex64 spectrum everything is single precision.
+
+    >>> if True:
+    ...     from TMO4CT.algorithm import conv, kernel_spectrum, mask_generation
+    ...     layers = np.random.RandomState(0).rand(3, 20, 15)
+    ...     fmask = kernel_spectrum((20, 15), 1.0, [1.2], [1.0], cache=None)
+    ...     mask = mask_generation(np.zeros((20, 15), dtype=np.float32),
+    ...                            1.0, [1.2], [1.0])
+    ...     result = fft_conv(layers, fmask, workers=2)
+    ...     print(np.allclose(result[1], conv(layers[1], mask)[0], atol=1e-6))
+    True
+    """
+    spectrum = fft_spectra(layers, np.finfo(fmask.dtype).dtype, workers)
+    spectrum *= fmask
+    return fft_inverse(spectrum, layers.shape[1:], workers, out)
+
+
+def fft_spectra(layers, dtype=np.float64, workers=1):
+    # Forward transforms of the reflect-padded layers of fft_conv()
+    shape = layers.shape[1:]
+    padded_shape = fft_shape(shape)
+    axes = tuple(range(1, layers.ndim))
+    pad = [(0, 0)] + [(n // 2, p - n - n // 2)
+                      for n, p in zip(shape, padded_shape)]
+    padded = np.pad(np.asarray(layers, dtype=dtype), pad, mode='reflect')
+    return scipy.fft.rfftn(padded, axes=axes, workers=workers)
+
+
+def fft_inverse(spectrum, shape, workers=1, out=None):
+    # Inverse of fft_spectra() for layers of 'shape', in place,
+    # cropped to the layers
+    padded_shape = fft_shape(shape)
+    axes = tuple(range(1, spectrum.ndim))
+    result = scipy.fft.irfftn(spectrum, s=padded_shape, axes=axes,
+                              workers=workers, overwrite_x=True)
+    if out is None:
+        out = np.empty((len(spectrum),) + tuple(shape), dtype=np.float32)
+    out[...] = result[(slice(None),) +
+                      tuple(slice(n // 2, n // 2 + n) for n in shape)]
+    return out
+
+
+def dct_kernel(mask, shape):
+    """
+    DCT-I transform of a symmetric, odd sized, centered mask for
+    dct_conv() on layers of the given shape.
+    Only the non-negative quadrant of the mask is needed.
+    """
+    quadrant = mask[tuple(slice(n // 2, None) for n in mask.shape)]
+    quadrant = quadrant[tuple(slice(0, n) for n in shape)]
+    padded = np.zeros(shape=shape, dtype=np.float64)
+    padded[tuple(slice(0, n) for n in quadrant.shape)] = quadrant
+    axes = _dct_axes(shape)
+    if not axes:
+        return padded
+    return scipy.fft.dctn(padded, type=1, axes=axes)
+
+
+def _dct_axes(shape, first=0):
+    # The DCT-I needs at least 2 samples; along a single sample axis the
+    # reflected layer is constant, so the convolution is the product
+    # with the center of the kernel, without a transform.
+    return tuple(first + i for i, n in enumerate(shape) if n > 1)
+
+
+def dct_conv(layers, fkernel, workers=1, out=None):
+    """
+    Convolution of a batch of layers (along the first axis) with a
+    symmetric kernel, with reflective boundaries, in the cosine
+    transform domain.
+
+    The DCT-I corresponds to the whole-sample symmetric extension,
+    which is the same as the 'reflect' padding, so there is no need
+    for padding: the transforms run on the unpadded layers, about
+    a quarter of the pixels of fft_conv().
+    The kernel must be symmetric along every axis, so for even sized
+    layers the kernel is centered on a pixel, instead of the half pixel
+    shifted kernel of fft_conv(). For odd sizes the two are equivalent:
+
+    >>> if True:
+    ...     from TMO4CT.algorithm import kernel_spectrum
+    ...     layers = np.random.RandomState(0).rand(3, 21, 15)
+    ...     args = ((21, 15), 1.0, [1.2], [1.0])
+    ...     a = fft_conv(layers, kernel_spectrum(*args, cache=None))
+    ...     b = dct_conv(layers, kernel_spectrum(*args, cache=None,
+    ...                                          backend='dct'))
+    ...     print(np.allclose(a, b, atol=1e-6))
+    True
+
+    Axes of length 1 (e.g. of a thin, downscaled volume) are not
+    transformed:
+
+    >>> if True:
+    ...     layers = np.random.RandomState(0).rand(2, 1, 9, 7)
+    ...     args = ((1, 9, 7), 1.0, [1.2], [1.0])
+    ...     a = fft_conv(layers, kernel_spectrum(*args, cache=None))
+    ...     b = dct_conv(layers, kernel_spectrum(*args, cache=None,
+    ...                                          backend='dct'))
+    ...     print(np.allclose(a, b, atol=1e-6))
+    True
+    """
+    spectrum = dct_spectra(layers, np.finfo(fkernel.dtype).dtype, workers)
+    spectrum *= fkernel
+    return dct_inverse(spectrum, layers.shape[1:], workers, out)
+
+
+def dct_spectra(layers, dtype=np.float64, workers=1):
+    # Forward transforms of the layers of dct_conv()
+    layers = np.asarray(layers, dtype=dtype)
+    axes = _dct_axes(layers.shape[1:], first=1)
+    if not axes:
+        return layers.copy()
+    return scipy.fft.dctn(layers, type=1, axes=axes, workers=workers)
+
+
+def dct_inverse(spectrum, shape, workers=1, out=None):
+    # Inverse of dct_spectra(), in place
+    axes = _dct_axes(spectrum.shape[1:], first=1)
+    result = spectrum
+    if axes:
+        result = scipy.fft.idctn(spectrum, type=1, axes=axes,
+                                 workers=workers, overwrite_x=True)
+    if out is None:
+        out = np.empty(spectrum.shape, dtype=np.float32)
+    out[...] = result
+    return out
+
+
+def spectrum_shape(shape, backend='fft'):
+    """
+    Shape of the transform of a layer of the given shape, for the
+    backends with a separate forward and inverse transform
+    (see transforms).
+
+    >>> spectrum_shape((100, 37)), spectrum_shape((100, 37), 'dct')
+    ((200, 38), (100, 37))
+    """
+    if backend == 'dct':
+        return tuple(shape)
+    padded_shape = fft_shape(shape)
+    return padded_shape[:-1] + (padded_shape[-1] // 2 + 1,)
+
+
+def direct_conv(layers, kernel, workers=1, out=None):
+    """
+    Direct convolution of a batch of layers (along the first axis) with
+    a small, odd sized, centered kernel, with reflective boundaries.
+
+    The cost is proportional to the footprint of the kernel, so it is
+    the fastest backend for a small R_cutoff. Every output pixel is the
+    sum of the same products in the same order, so the result does not
+    depend on the size of the layers: it is the same for a part of the
+    layers, as far as the kernel does not reach the edges of the part.
+    The batch is split between 'workers' threads.
+
+    >>> if True:
+    ...     from TMO4CT.algorithm import kernel_spectrum
+    ...     layers = np.random.RandomState(0).rand(3, 20, 15)
+    ...     args = ((20, 15), 1.0, [1.2], [1.0], 3.5)
+    ...     a = fft_conv(layers, kernel_spectrum(*args, cache=None))
+    ...     b = direct_conv(layers, kernel_spectrum(*args, cache=None,
+    ...                                             backend='direct'))
+    ...     print(np.allclose(a, b, atol=1e-6))
+    True
+    """
+    import scipy.ndimage  # only imported for this backend
+    dtype = np.finfo(kernel.dtype).dtype
+    if out is None:
+        out = np.empty(layers.shape, dtype=np.float32)
+
+    def convolve(start, stop):
+        out[start:stop] = scipy.ndimage.convolve(
+            np.asarray(layers[start:stop], dtype=dtype),
+            kernel[None], mode='mirror')
+
+    chunk = -(-len(layers) // max(1, workers))
+    starts = range(0, len(layers), chunk)
+    if workers > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(workers) as pool:
+            list(pool.map(lambda i: convolve(i, i + chunk), starts))
+    else:
+        for start in starts:
+            convolve(start, start + chunk)
+    return out
+
+
+def yvv_coefficients(sigma):
+    """
+    Coefficients (B, a1, a2, a3) of the Young & van Vliet (1995)
+    third order recursive Gaussian filter, valid for sigma >= 0.5.
+
+    >>> print(np.round(yvv_coefficients(3.0), 4))
+    [ 0.1016  1.6991 -1.0176  0.2168]
+    """
+    if sigma >= 2.5:
+        q = 0.98711 * sigma - 0.96330
+    else:
+        q = 3.97156 - 4.14554 * np.sqrt(1 - 0.26891 * sigma)
+    b0 = 1.57825 + 2.44413 * q + 1.4281 * q**2 + 0.422205 * q**3
+    b1 = 2.44413 * q + 2.85619 * q**2 + 1.26661 * q**3
+    b2 = -(1.4281 * q**2 + 1.26661 * q**3)
+    b3 = 0.422205 * q**3
+    B = 1 - (b1 + b2 + b3) / b0
+    return np.array([B, b1 / b0, b2 / b0, b3 / b0])
+
+
+@jit
+def _yvv_filter(y, B, a1, a2, a3, offset):
+    # y is (outer, n, inner), filtered along the middle axis, in place;
+    # the inner loops run over contiguous memory. The signal is shifted
+    # by 'offset' during the filtering: the decaying tails would be
+    # denormal numbers in the empty regions, which are very slow.
+    n = y.shape[1]
+    for o in range(y.shape[0]):
+        # steady state initialization: constant extension of the edges
+        p1 = y[o, 0] + offset
+        p2 = p1.copy()
+        p3 = p1.copy()
+        for i in range(n):
+            for j in range(y.shape[2]):
+                v = B * (y[o, i, j] + offset) + \
+                    a1 * p1[j] + a2 * p2[j] + a3 * p3[j]
+                p3[j] = p2[j]
+                p2[j] = p1[j]
+                p1[j] = v
+                y[o, i, j] = v
+        p1[:] = y[o, n - 1]
+        p2[:] = y[o, n - 1]
+        p3[:] = y[o, n - 1]
+        for i in range(n - 1, -1, -1):
+            for j in range(y.shape[2]):
+                v = B * y[o, i, j] + a1 * p1[j] + a2 * p2[j] + a3 * p3[j]
+                p3[j] = p2[j]
+                p2[j] = p1[j]
+                p1[j] = v
+                y[o, i, j] = v - offset
+
+
+def recursive_gaussian(x, sigma, axis=0):
+    """
+    Gaussian filtering of the contiguous array 'x' along 'axis', in
+    place, with a causal and an anti-causal recursive pass.
+    The cost does not depend on sigma.
+    The signal is extended with its edge values.
+    The impulse response is close to the sampled Gaussian, but it has
+    somewhat heavier tails, so fits should use the actual response.
+
+    >>> if True:
+    ...     x = np.zeros(101)
+    ...     x[50] = 1
+    ...     x = recursive_gaussian(x, 5.0)
+    ...     g = np.exp(-(np.arange(101) - 50)**2 / 50.)
+    ...     print(np.abs(x - g / g.sum()).max() < 5e-3, round(x.sum(), 4))
+    True 1.0
+    """
+    B, a1, a2, a3 = yvv_coefficients(sigma)
+    axis = axis % x.ndim
+    if axis == x.ndim - 1 and x.ndim > 1:
+        # the recursion is sequential along the filtered axis, the
+        # filter is much faster along an axis with contiguous lines
+        y = np.ascontiguousarray(np.swapaxes(x, -1, -2))
+        recursive_gaussian(y, sigma, axis=axis - 1)
+        x[...] = np.swapaxes(y, -1, -2)
+        return x
+    y = x.reshape(int(np.prod(x.shape[:axis])), x.shape[axis], -1)
+    _yvv_filter(y, x.dtype.type(B), x.dtype.type(a1),
+                x.dtype.type(a2), x.dtype.type(a3),
+                np.sqrt(np.finfo(x.dtype).tiny).astype(x.dtype))
+    return x
+
+
+def _downsample(x):
+    # mean of 2x..x2 blocks, along every axis except the first
+    for axis in range(1, x.ndim):
+        even = (slice(None),) * axis + (slice(0, None, 2),)
+        odd = (slice(None),) * axis + (slice(1, None, 2),)
+        x = (x[even] + x[odd]) * 0.5
+    return x
+
+
+def _upsample(x, sizes):
+    # linear interpolation of the coarse pixels -1..N+1 to the fine
+    # pixels -1..n+1, n is given by 'sizes'; the fine pixels 2 * c + 1
+    # and 2 * c + 2 are between the coarse pixels c and c + 1, at 1/4
+    # and 3/4
+    for axis, n in enumerate(sizes, 1):
+        head = (slice(None),) * axis
+        left, right = x[head + (slice(0, -1),)], x[head + (slice(1, None),)]
+        shape = list(x.shape)
+        shape[axis] = 2 * (shape[axis] - 1)
+        y = np.empty(shape, dtype=x.dtype)
+        y[head + (slice(0, None, 2),)] = 0.75 * left + 0.25 * right
+        y[head + (slice(1, None, 2),)] = 0.25 * left + 0.75 * right
+        x = y[head + (slice(0, n + 2),)]
+    return x
+
+
+def _extend(x, shape, level, margins):
+    # pixels -m..N+m of the coarse grid 'level' along every axis, the
+    # layers are mirrored at their first and last pixels ('reflect');
+    # the mirrored pixels fall between the coarse pixels, so they are
+    # interpolated linearly, except at the full resolution
+    step = 2**level
+    for axis, (n, m) in enumerate(zip(shape, margins), 1):
+        head = (slice(None),) * axis
+        size = x.shape[axis]
+        extended = list(x.shape)
+        extended[axis] += 2 * m
+        y = np.empty(extended, dtype=x.dtype)
+        y[head + (slice(m, m + size),)] = x
+
+        c = np.concatenate((np.arange(-m, 0), np.arange(size, size + m)))
+        u = (c + 0.5) * step - 0.5
+        u = np.where(u < 0, -u, u)
+        u = np.clip(np.where(u > n - 1, 2 * (n - 1) - u, u), 0, n - 1)
+        t = np.clip((u + 0.5) / step - 0.5, 0, size - 1)
+        i = np.minimum(np.floor(t).astype(int), max(0, size - 2))
+        w = (t - i).astype(x.dtype).reshape((-1,) + (1,) * (x.ndim - axis - 1))
+        edges = np.take(x, i, axis=axis)
+        if w.any():
+            edges *= 1 - w
+            edges += np.take(x, np.minimum(i + 1, size - 1), axis=axis) * w
+        y[head + (slice(0, m),)] = edges[head + (slice(0, m),)]
+        y[head + (slice(m + size, None),)] = edges[head + (slice(m, None),)]
+        x = y
+    return x
+
+
+def pyramid_levels(shape, sigmas, min_sigma=2.0, min_size=32):
+    """
+    Pyramid level of Gaussians for gaussian_conv() on layers of the
+    given shape: the layers are downsampled by 2**level, until the
+    sigma is below 2 * 'min_sigma', while the layers are at least
+    'min_size' pixels along every axis.
+
+    >>> pyramid_levels((512, 300), [0.5, 3.0, 5.0, 40.0, 200.0])
+    [0, 0, 1, 3, 3]
+    """
+    depth = 0
+    while 2**(depth + 1) * min_size <= min(shape):
+        depth += 1
+    return [min(depth, max(0, int(np.floor(np.log2(sigma / min_sigma)))))
+            for sigma in sigmas]
+
+
+def gaussian_conv(layers, fkernel, workers=1, out=None):
+    """
+    Approximate convolution of a batch of layers (along the first axis)
+    with a weighted sum of Gaussians, plus a weighted center pixel,
+    with reflective boundaries.
+
+    fkernel[0] is (center weight, fit error, 0), the other rows are
+    (weight, sigma, pyramid level), see algorithm.gaussian_fit().
+    Every Gaussian is applied with separable recursive filters, so the
+    cost does not depend on its size. The wide Gaussians are applied on
+    a pyramid of block averaged layers, downsampled by 2**level (see
+    pyramid_levels()), and the levels are accumulated with linear
+    interpolation, so the total cost is about two Gaussians on the full
+    resolution layers. The batch is split between 'workers' threads.
+    The layers are reflected as far as the Gaussians reach, at most
+    by half of their size, like the kernel of fft_conv(), and they
+    are extended with the edge values beyond that.
+
+    >>> if True:
+    ...     layers = np.zeros((1, 41, 41))
+    ...     layers[0, 20, 20] = 1
+    ...     fkernel = np.array([[0.5, 0.0, 0], [0.5, 3.0, 0]])
+    ...     result = gaussian_conv(layers, fkernel)
+    ...     print(round(float(result.sum()), 3), round(result[0, 20, 20], 3))
+    1.0 0.509
+
+    The downsampled Gaussians are close to the full resolution ones:
+
+    >>> if True:
+    ...     layers = np.zeros((2, 200, 150))
+    ...     layers[:, 50:120, 30:80] = 1
+    ...     a = gaussian_conv(layers, np.array([[0, 0, 0], [1, 20.0, 3]]))
+    ...     b = gaussian_conv(layers, np.array([[0, 0, 0], [1, 20.0, 0]]))
+    ...     print(np.abs(a - b).max() < 0.05 * b.max())
+    True
+    """
+    shape = layers.shape[1:]
+    dtype = np.finfo(fkernel.dtype).dtype
+    if out is None:
+        out = np.empty(layers.shape, dtype=np.float32)
+
+    levels = [int(k) for k in fkernel[1:, 2]]
+    depth = max(levels + [0])
+    step = 2**depth
+    # the layers are extended to a multiple of the coarsest pixels, and
+    # the accumulators cover the layers and one more coarse pixel around
+    extra = [-n % step for n in shape]
+    sizes = [[(n + e) // 2**k for n, e in zip(shape, extra)]
+             for k in range(depth + 1)]
+
+    def convolve(start, stop):
+        x = np.asarray(layers[start:stop], dtype=dtype)
+        pyramid = [np.pad(x, [(0, 0)] + [(0, e) for e in extra],
+                          mode='reflect')]
+        for k in range(depth):
+            pyramid.append(_downsample(pyramid[-1]))
+        acc = [np.zeros((len(x),) + tuple(n + 2 for n in sizes[k]),
+                        dtype=dtype) for k in range(depth + 1)]
+
+        for (weight, sigma, _), k in zip(fkernel[1:], levels):
+            if weight == 0:
+                continue
+            # the Gaussian only needs the neighbourhood it reaches, and
+            # the reflection is at most half of the layer, like the kernel
+            sigma_k = sigma / 2**k
+            margins = [1 + min(int(np.ceil(6 * sigma_k)) + 1,
+                               -(-(n // 2) // 2**k)) for n in shape]
+            y = _extend(pyramid[k], shape, k, margins)
+            for axis in range(1, y.ndim):
+                recursive_gaussian(y, sigma_k, axis=axis)
+            acc[k] += weight * y[(slice(None),) +
+                                 tuple(slice(m - 1, m + n + 1)
+                                       for m, n in zip(margins, sizes[k]))]
+
+        for k in range(depth, 0, -1):
+            acc[k - 1] += _upsample(acc[k], sizes[k - 1])
+        result = acc[0][(slice(None),) + tuple(slice(1, n + 1) for n in shape)]
+        result += fkernel[0, 0] * x
+        out[start:stop] = result
+
+    chunk = -(-len(layers) // max(1, workers))
+    starts = range(0, len(layers), chunk)
+    if workers > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(workers) as pool:
+            list(pool.map(lambda i: convolve(i, i + chunk), starts))
+    else:
+        for start in starts:
+            convolve(start, start + chunk)
+    return out
+
+
+backends = {'fft': fft_conv,
+            'dct': dct_conv,
+            'direct': direct_conv,
+            'approximate': gaussian_conv}
+
+# forward and inverse transforms of the backends working in the
+# transform domain, the convolution is the product of the transforms
+transforms = {'fft': (fft_spectra, fft_inverse),
+              'dct': (dct_spectra, dct_inverse)}
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from .algorithm import kernel_spectrum, histogram_shape, check_backend
+from .algorithm import stack_mapping, histogram_stack, normalize_stack
+from .algorithm import cdf_transform, cdf_interpolation, progress
+from .cache import kernel_cache
+from .convolution import batch_size as default_batch_size
+from .convolution import transforms, spectrum_shape
+from .tools import eprint, rebin_stack, array_ctx
+
+
+class ToneMapper(object):
+    """
+    Tone mapping of a series of images of the same shape with the same
+    parameters (see tone_mapping()), e.g. the slices of a CT series.
+
+    The kernel is generated once, and the histogram stack and the
+    layer index image are allocated once per thread, and reused for
+    every image (the stack grows, if an image has more gray levels).
+    There is no garbage collection between the steps.
+    fit() returns the GAIN independent part of the tone mapping
+    of an image (see HistogramModel).
+
+    >>> if True:
+    ...     from TMO4CT.algorithm import tone_mapping
+    ...     rng = np.random.RandomState(0)
+    ...     slices = rng.randint(0, 20, (3, 32, 40))
+    ...     kw = dict(GAIN=2.0, exps=[1.2], factors=[1.0], MAX=1.0,
+    ...               downscale=4)
+    ...     mapper = ToneMapper((32, 40), **kw)
+    ...     a = [mapper(x, x) for x in slices]
+    ...     b = [tone_mapping(x, x, **kw) for x in slices]
+    ...     print(np.array_equal(a, b))
+    True
+    """
+
+    def __init__(self, shape,
+                 GAIN=None,
+                 exps=None,
+                 factors=None,
+                 MAX=None,
+                 R_cutoff=np.inf,
+                 downscale=None,
+                 distance_metric='eucledian',
+                 backend='fft',
+                 fft_precision=np.float64,
+                 precision=np.float32,
+                 batch_size=None,
+                 workers=1,
+                 spacing=None,
+                 cache=kernel_cache):
+        check_backend(backend, R_cutoff)
+        self.shape = tuple(shape)
+        self.grid_shape = histogram_shape(shape, downscale)
+        self.GAIN = GAIN
+        self.backend = backend
+        self.precision = precision
+        self.workers = workers
+        self.batch_size = (batch_size or
+                           default_batch_size(self.grid_shape))
+        self.fmask = kernel_spectrum(self.grid_shape,
+                                     MAX,
+                                     exps,
+                                     factors,
+                                     R_cutoff,
+                                     distance_metric,
+                                     cache=cache,
+                                     backend=backend,
+                                     precision=fft_precision,
+                                     spacing=spacing)
+        self._local = threading.local()
+
+    def _buffers(self, n_levels, n_layers):
+        # the work buffers of the calling thread
+        local = self._local
+        if getattr(local, 'compact', None) is None:
+            local.compact = np.zeros(0, dtype=np.int32)
+            local.index = np.empty(self.shape, dtype=np.int32)
+            local.stack = np.empty((0,) + self.grid_shape,
+                                   dtype=self.precision)
+        if len(local.compact) < n_levels:
+            local.compact = np.zeros(n_levels, dtype=np.int32)
+        if len(local.stack) < n_layers:
+            local.stack = None
+            local.stack = np.empty((n_layers,) + self.grid_shape,
+                                   dtype=self.precision)
+        return local.compact, local.index, local.stack[:n_layers]
+
+    def _index(self, data):
+        # Only the occupied gray levels are stored: the levels, and the
+        # image of the layer indices, with the stack buffer
+        counts = np.bincount(data.ravel())
+        levels = np.flatnonzero(counts)
+        n_levels = len(counts)
+        compact, index, test = self._buffers(n_levels, len(levels))
+        compact[levels] = np.arange(len(levels))
+        np.take(compact, data, out=index)
+        return levels, n_levels, index, test
+
+    def __call__(self, data_orig, data, out=None, workers=None):
+        """
+        Tone mapping of 'data_orig' with its binned version 'data',
+        the result is written into 'out', if it is given.
+        'workers' (default: the workers of the mapper) is the number
+        of threads of the convolution and the interpolation.
+        """
+        if workers is None:
+            workers = self.workers
+        levels, n_levels, index, test = self._index(data)
+        return stack_mapping(test, index, data_orig, levels, n_levels,
+                             self.GAIN, self.fmask,
+                             backend=self.backend,
+                             batch_size=self.batch_size,
+                             workers=workers,
+                             out=out)
+
+    def fit(self, data_orig, data):
+        """
+        The normalized local histograms of 'data' (the binned version
+        of 'data_orig'), as a HistogramModel. The model has its own
+        copy of the stack.
+        """
+        levels, n_levels, index, _ = self._index(data)
+        test = np.empty((len(levels),) + self.grid_shape,
+                        dtype=self.precision)
+        test = histogram_stack(test, index, self.fmask,
+                               backend=self.backend,
+                               batch_size=self.batch_size,
+                               workers=self.workers)
+        normalize_stack(test)
+        return HistogramModel(test, levels, n_levels, data_orig,
+                              GAIN=self.GAIN, workers=self.workers)
+
+
+class HistogramModel(object):
+    """
+    The normalized local histograms of an image (see ToneMapper.fit()),
+    everything of the tone mapping which does not depend on GAIN.
+
+    apply() only clips, redistributes and accumulates the histograms
+    for the given GAIN, and maps the image with the CDF, so the
+    convolutions are not repeated. The CDF of the last GAIN is kept,
+    so other images with the same bins (e.g. with another dynamic
+    range) are mapped with the interpolation only.
+    The model needs twice the memory of the histogram stack.
+
+    >>> if True:
+    ...     from TMO4CT.algorithm import tone_mapping
+    ...     data = np.random.RandomState(0).randint(0, 20, (32, 40))
+    ...     kw = dict(exps=[1.2], factors=[1.0], MAX=1.0, downscale=4)
+    ...     model = ToneMapper(data.shape, **kw).fit(data, data)
+    ...     for GAIN in [1.5, 4.0]:
+    ...         a = model.apply(GAIN)
+    ...         b = tone_mapping(data, data, GAIN=GAIN, **kw)
+    ...         print(np.array_equal(a, b))
+    True
+    True
+    """
+
+    def __init__(self, stack, levels, n_levels, data_orig,
+                 GAIN=None, workers=1):
+        self.stack = stack
+        self.levels = levels
+        self.n_levels = n_levels
+        self.data_orig = data_orig
+        self.GAIN = GAIN
+        self.workers = workers
+        self._cdf = None
+        self._gain = None
+        self._s = None
+
+    @property
+    def shape(self):
+        return self.data_orig.shape
+
+    def cdf(self, GAIN=None):
+        # the CDF stack and the redistributed weights for GAIN
+        if GAIN is None:
+            GAIN = self.GAIN
+        if self._cdf is None or self._gain != GAIN:
+            if self._cdf is None:
+                self._cdf = np.empty_like(self.stack)
+            np.copyto(self._cdf, self.stack)
+            self._s = cdf_transform(self._cdf, self.levels, self.n_levels,
+                                    GAIN, normalized=True)
+            self._gain = GAIN
+        return self._cdf, self._s
+
+    def apply(self, GAIN=None, data_orig=None, out=None):
+        """
+        Tone mapping with the given GAIN (default: the GAIN of the
+        mapper) of the fitted image, or of 'data_orig', which must have
+        the same shape and bins.
+        """
+        if data_orig is None:
+            data_orig = self.data_orig
+        if data_orig.shape != self.shape:
+            eprint('The image does not match the shape of the model')
+            sys.exit(1)
+        cdf, s = self.cdf(GAIN)
+        return cdf_interpolation(cdf, s, self.levels, self.n_levels,
+                                 data_orig, workers=self.workers, out=out)
+
+
+def kernel_sweep(data_orig, data, kernels,
+                 GAIN=None,
+                 exps=None,
+                 factors=None,
+                 MAX=None,
+                 R_cutoff=np.inf,
+                 distance_metric='eucledian',
+                 downscale=None,
+                 backend='fft',
+                 fft_precision=np.float64,
+                 precision=np.float32,
+                 batch_size=None,
+                 workers=1,
+                 spacing=None,
+                 tempdir=None,
+                 verbosity=0,
+                 cache=kernel_cache):
+    """
+    tone_mapping() of the same image with several kernels.
+    'kernels' is a list of dicts, each of them overrides some of the
+    GAIN, exps, factors, MAX, R_cutoff and distance_metric arguments.
+    Returns the list of the results.
+
+    The forward transforms of the occupied layers do not depend on the
+    kernel, so they are calculated once, and stored in memory, or in
+    a memory mapped file in 'tempdir'. Every kernel costs a product
+    and an inverse transform per layer, besides the CDF and the
+    interpolation. The stored spectra need about 8 times (fft, double
+    precision; 4 times with single precision fft_precision) or
+    2 times (dct) the memory of the histogram stack.
+    Only the fft and dct backends are supported.
+
+    >>> if True:
+    ...     from TMO4CT.algorithm import tone_mapping
+    ...     data = np.random.RandomState(0).randint(0, 20, (32, 40))
+    ...     kw = dict(GAIN=2.0, exps=[1.2], factors=[1.0], MAX=1.0,
+    ...               downscale=4)
+    ...     kernels = [{}, {'exps': [0.8]}, {'distance_metric': 'maximum',
+    ...                                      'GAIN': 4.0}]
+    ...     results = kernel_sweep(data, data, kernels, **kw)
+    ...     for kernel, a in zip(kernels, results):
+    ...         b = tone_mapping(data, data, **dict(kw, **kernel))
+    ...         print(np.array_equal(a, b))
+    True
+    True
+    True
+    """
+    if backend not in transforms:
+        eprint('Kernel sweeps need the fft or dct backend')
+        sys.exit(1)
+    forward, inverse = transforms[backend]
+    defaults = dict(GAIN=GAIN, exps=exps, factors=factors, MAX=MAX,
+                    R_cutoff=R_cutoff, distance_metric=distance_metric)
+    for kernel in kernels:
+        unknown = set(kernel) - set(defaults)
+        if unknown:
+            eprint('Unknown kernel parameters: ' + ', '.join(sorted(unknown)))
+            sys.exit(1)
+
+    original_shape = data_orig.shape
+    downscaled_shape = histogram_shape(original_shape, downscale)
+    if batch_size is None:
+        batch_size = default_batch_size(downscaled_shape)
+    dtype = np.dtype(fft_precision)
+    complex_dtype = np.result_type(dtype, np.complex64)
+
+    counts = np.bincount(data.ravel())
+    levels = np.flatnonzero(counts)
+    n_levels = len(counts)
+    compact = np.zeros(n_levels, dtype=np.min_scalar_type(len(levels)))
+    compact[levels] = np.arange(len(levels))
+
+    results = []
+    spectra_shape = spectrum_shape(downscaled_shape, backend)
+    with array_ctx((len(levels), *downscaled_shape),
+                   dtype=precision,
+                   tempdir=tempdir) as test, \
+            array_ctx((len(levels), *spectra_shape),
+                      dtype=dtype if backend == 'dct' else complex_dtype,
+                      tempdir=tempdir) as spectra:
+        test = rebin_stack(compact[data], test)
+        compact = None
+        batches = range(0, len(levels), batch_size)
+        for i in batches:
+            spectra[i:i + batch_size] = forward(test[i:i + batch_size],
+                                                dtype, workers)
+
+        for kernel in progress(kernels, verbosity):
+            args = dict(defaults, **kernel)
+            fmask = kernel_spectrum(downscaled_shape,
+                                    args['MAX'],
+                                    args['exps'],
+                                    args['factors'],
+                                    args['R_cutoff'],
+                                    args['distance_metric'],
+                                    cache=cache,
+                                    backend=backend,
+                                    precision=fft_precision,
+                                    spacing=spacing)
+            for i in batches:
+                inverse(spectra[i:i + batch_size] * fmask, downscaled_shape,
+                        workers, out=test[i:i + batch_size])
+            s = cdf_transform(test, levels, n_levels, args['GAIN'])
+            results.append(cdf_interpolation(test, s, levels, n_levels,
+                                             data_orig, workers=workers))
+        test = None
+        spectra = None
+    return results
+
+
+def tone_mapping_batch(stack_orig, stack, workers=1, verbosity=0, **kwargs):
+    """
+    tone_mapping() of every image of a stack of same-shape images
+    (along the first axis) with a single ToneMapper. The images are
+    processed in parallel on 'workers' threads (-1: all cores);
+    the other arguments are the parameters of ToneMapper.
+
+    >>> if True:
+    ...     from TMO4CT.algorithm import tone_mapping
+    ...     rng = np.random.RandomState(0)
+    ...     slices = rng.randint(0, 20, (4, 32, 40))
+    ...     kw = dict(GAIN=2.0, exps=[1.2], factors=[1.0], MAX=1.0,
+    ...               downscale=4)
+    ...     a = tone_mapping_batch(slices, slices, workers=2, **kw)
+    ...     b = [tone_mapping(x, x, **kw) for x in slices]
+    ...     print(a.shape, np.array_equal(a, b))
+    (4, 32, 40) True
+    """
+    if workers < 0:
+        workers = max(1, (os.cpu_count() or 1) + 1 + workers)
+    mapper = ToneMapper(stack_orig.shape[1:], **kwargs)
+    result = np.empty(stack_orig.shape, dtype=np.float64)
+
+    def mapping(i):
+        mapper(stack_orig[i], stack[i], out=result[i], workers=1)
+
+    slices = range(len(stack_orig))
+    if workers > 1:
+        with ThreadPoolExecutor(workers) as pool:
+            list(progress(pool.map(mapping, slices), verbosity,
+                          total=len(slices)))
+    else:
+        for i in progress(slices, verbosity):
+            mapping(i)
+    return result
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
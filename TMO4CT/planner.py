@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import re
+import sys
+import tempfile
+import numpy as np
+
+from .tools import eprint, jit_enabled
+from .algorithm import histogram_shape
+from .convolution import fft_shape
+from .convolution import batch_size as default_batch_size
+
+# the downscale factors tried by memory_plan(), finest first
+DOWNSCALES = (1, 2, 4, 8, 16, 32)
+
+# memory_plan() keeps this much headroom over the estimates
+# (the measured peaks were within 5%)
+MARGIN = 1.1
+
+# the smallest chunks of memory_plan()
+MIN_CHUNK_PIXELS = 2**12
+MIN_CHUNK_BYTES = 2**20
+
+
+def parse_bytes(text):
+    """
+    Memory size with an optional binary unit (K, M, G, T).
+
+    >>> parse_bytes('512M'), parse_bytes('1.5g'), parse_bytes('1000')
+    (536870912, 1610612736, 1000)
+    """
+    match = re.match(r'^\s*([0-9.]+)\s*([kmgt]?)i?b?\s*$', str(text).lower())
+    if match is None:
+        eprint('Invalid memory size: {}'.format(text))
+        sys.exit(1)
+    unit = 1024 ** ' kmgt'.index(match.group(2) or ' ')
+    return int(float(match.group(1)) * unit)
+
+
+def format_bytes(n):
+    """
+    >>> format_bytes(1536), format_bytes(3 * 2**30)
+    ('1.5 KiB', '3.0 GiB')
+    """
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(n) < 1024:
+            break
+        n /= 1024.
+    else:
+        unit = 'TiB'
+    return '{:.1f} {}'.format(n, unit) if unit != 'B' else '{} B'.format(n)
+
+
+def memory_estimate(shape, n_layers, downscale=None, batch_size=None,
+                    backend='fft', fft_precision=np.float64,
+                    precision=np.float32, storage=None, memmap=False,
+                    streaming=False, chunk_bytes=64 * 2**20,
+                    chunk_pixels=2**18, workers=1, overhead=0):
+    """
+    Estimated memory use (in bytes) of the stages of tone_mapping()
+    for an image (or volume) of 'shape' with 'n_layers' occupied
+    gray levels. The estimates are the measured peaks of the stages
+    (see the comments), rounded up:
+
+    - image: the image, the layer indices, the float64 result,
+      and the 'overhead' of the caller,
+    - stack: the histogram stack (zero, if it is memory mapped),
+    - kernel: the kernel spectrum,
+    - convolution: the working memory of a batch of layers,
+    - cdf: the temporaries of cdf_transform(),
+    - interpolation: the temporaries of cdf_interpolation(), for
+      each of its 'workers' threads (-1 is all cores),
+    - peak: the image, the stack and the kernel, with the largest of
+      the other stages.
+
+    >>> e = memory_estimate((512, 512), 1000, downscale=4, batch_size=8)
+    >>> e['stack'] == 1000 * 128 * 128 * 4, e['peak'] < 2**30
+    (True, True)
+    >>> f = [memory_estimate((512, 512), 1000, downscale=4, batch_size=8,
+    ...                      chunk_pixels=2**16, workers=w)
+    ...      for w in (1, 4, 8)]
+    >>> [g['interpolation'] // f[0]['interpolation'] for g in f]
+    [1, 4, 4]
+    """
+    pixels = int(np.prod(shape))
+    grid = histogram_shape(shape, downscale)
+    nodes = int(np.prod(grid))
+    if batch_size is None:
+        batch_size = default_batch_size(grid)
+    if storage is not None:
+        precision = np.uint16
+    itemsize = np.dtype(fft_precision).itemsize
+
+    # float32 image, (at most) 16 bit layer indices, float64 result
+    image = pixels * (4 + 2 + 2 + 8) + overhead
+    stack = 0 if memmap else n_layers * nodes * np.dtype(precision).itemsize
+
+    # per layer: the padded layer and its spectrum (fft), the layer
+    # and its transform (dct), the float64 output of ndimage (direct),
+    # the pyramid levels (approximate)
+    if backend == 'fft':
+        padded = int(np.prod(fft_shape(grid)))
+        kernel = padded * itemsize
+        layer = 2 * padded * itemsize
+    elif backend == 'dct':
+        kernel = nodes * itemsize
+        layer = 2 * nodes * itemsize
+    elif backend == 'direct':
+        kernel = 0
+        layer = 16 * nodes
+    else:
+        kernel = 0
+        layer = 64 * nodes
+    convolution = min(batch_size, n_layers) * layer
+    if storage is not None or streaming:
+        # float32 batch buffer, and the pixels sorted by layers
+        convolution += min(batch_size, n_layers) * nodes * 4 + pixels * 8
+
+    # the float32 's', and the blocks of the numpy version (and the
+    # converted float16 blocks of the fused one)
+    cdf = nodes * 8
+    if not jit_enabled:
+        cdf += 2 * chunk_bytes
+    elif storage == 'float16':
+        cdf += chunk_bytes // 4
+    if streaming:
+        cdf += nodes * 16
+
+    # about a dozen float64 arrays per pixel, and the corner weights,
+    # for every chunk in flight
+    if workers < 0:
+        workers = max(1, (os.cpu_count() or 1) + 1 + workers)
+    chunks = min(max(1, workers), -(-pixels // chunk_pixels))
+    interpolation = chunks * min(pixels, chunk_pixels) * \
+        (96 + 8 * 2**len(shape))
+
+    peak = image + stack + kernel + max(convolution, cdf, interpolation)
+    return {'image': image,
+            'stack': stack,
+            'kernel': kernel,
+            'convolution': convolution,
+            'cdf': cdf,
+            'interpolation': interpolation,
+            'peak': peak}
+
+
+def memory_plan(shape, n_layers, max_memory, downscale=None,
+                batch_size=None, storage=None, tempdir=None,
+                backend='fft', fft_precision=np.float64, streaming=False,
+                workers=1, overhead=0):
+    """
+    Parameters of tone_mapping() for the memory budget 'max_memory'
+    (in bytes): downscale, batch_size, storage, tempdir, chunk_bytes
+    and chunk_pixels. The given parameters are kept, the rest are
+    chosen by memory_estimate(), preferring
+    - the finest downscale with an in-memory stack (float32, then
+      uint16 storage),
+    - then the finest downscale with a memory mapped stack
+      (in 'tempdir', or in the system's temporary directory),
+    - with the largest batches and chunks.
+    Exits with an error message, if the budget is impossible.
+
+    >>> p = memory_plan((512, 512), 1000, 256 * 2**20)
+    >>> p['downscale'], p['storage'], p['tempdir'] is None
+    (2, 'uint16', True)
+    >>> p = memory_plan((512, 512), 1000, 64 * 2**20, downscale=1)
+    >>> p['storage'], p['tempdir'] is not None
+    (None, True)
+    """
+    downscales = DOWNSCALES if downscale is None else (downscale,)
+    if storage is not None or streaming:
+        storages = (storage,)
+    else:
+        storages = (None, 'uint16')
+
+    candidates = []
+    if tempdir is None:
+        candidates += [(d, s, None) for d in downscales for s in storages]
+    candidates += [(d, s, tempdir or tempfile.gettempdir())
+                   for d in downscales for s in storages]
+
+    estimate = None
+    for d, s, directory in candidates:
+        grid = histogram_shape(shape, d)
+        batch = batch_size or default_batch_size(grid)
+        chunk_bytes, chunk_pixels = 64 * 2**20, 2**18
+        while True:
+            estimate = memory_estimate(shape, n_layers, downscale=d,
+                                       batch_size=batch, backend=backend,
+                                       fft_precision=fft_precision,
+                                       storage=s,
+                                       memmap=directory is not None,
+                                       streaming=streaming,
+                                       chunk_bytes=chunk_bytes,
+                                       chunk_pixels=chunk_pixels,
+                                       workers=workers,
+                                       overhead=overhead)
+            if estimate['peak'] * MARGIN <= max_memory:
+                return {'downscale': d,
+                        'batch_size': batch,
+                        'storage': s,
+                        'tempdir': directory,
+                        'chunk_bytes': chunk_bytes,
+                        'chunk_pixels': chunk_pixels,
+                        'memory': estimate}
+            if (batch == 1 or batch_size) and \
+                    chunk_bytes == MIN_CHUNK_BYTES and \
+                    chunk_pixels == MIN_CHUNK_PIXELS:
+                break
+            if not batch_size:
+                batch = max(1, batch // 2)
+            chunk_bytes = max(MIN_CHUNK_BYTES, chunk_bytes // 2)
+            chunk_pixels = max(MIN_CHUNK_PIXELS, chunk_pixels // 2)
+
+    eprint('The memory budget of {} is not enough, at least {} '
+           'is needed'.format(format_bytes(max_memory),
+                              format_bytes(estimate['peak'] * MARGIN)))
+    sys.exit(1)
+
+
+def print_plan(plan):
+    # the plan, and the estimates of the stages, for the verbose mode
+    eprint('    Memory plan          : downscale {downscale}, batch size '
+           '{batch_size}, storage {storage}'.format(
+               downscale=plan['downscale'], batch_size=plan['batch_size'],
+               storage=plan['storage'] or 'float32'))
+    eprint('                           chunks of {} / {} pixels, '
+           'stack in {}'.format(format_bytes(plan['chunk_bytes']),
+                                plan['chunk_pixels'],
+                                plan['tempdir'] or 'memory'))
+    eprint('    Memory estimate      : ' + ', '.join(
+        '{} {}'.format(k, format_bytes(v))
+        for k, v in plan['memory'].items()))
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
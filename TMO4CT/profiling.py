@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+
+class Profiler(object):
+    """
+    Wall time and peak memory of the stages of the processing
+    (see stage()), while the profiler is active (see activate()).
+    The memory is the memory traced by tracemalloc (numpy arrays
+    included), if 'memory' is set; 'peak' is the highest traced
+    memory during the stage, 'delta' is its increase over the traced
+    memory at the start of the stage. The 'callback' gets the name,
+    the time and the peak memory at the end of every stage.
+
+    >>> if True:
+    ...     import numpy as np
+    ...     profiler = Profiler()
+    ...     with activate(profiler):
+    ...         with stage('outer'):
+    ...             a = np.zeros(2**20)
+    ...             with stage('inner'):
+    ...                 b = np.zeros(2**21)
+    ...                 b = None
+    ...     stats = profiler.stats()
+    ...     print(list(stats), stats['inner']['calls'],
+    ...           stats['inner']['delta'] >= 2**24,
+    ...           stats['outer']['delta'] >= 2**24 + 2**23)
+    ['outer', 'inner'] 1 True True
+
+    Without an active profiler, the stages do nothing:
+
+    >>> stage('outer') is stage('inner')
+    True
+    """
+
+    def __init__(self, memory=True, callback=None):
+        self.memory = memory
+        self.callback = callback
+        self._stages = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._tracing = False
+        self._offset = 0
+
+    def start(self):
+        self._offset = 0
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+
+    def stop(self):
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    @contextmanager
+    def stage(self, name):
+        # the peaks of the enclosing stages are on the stack: tracemalloc
+        # has a single peak, which is reset for every stage
+        stack = self._local.__dict__.setdefault('stack', [])
+        self._entry(name)
+        tracing = self.memory and tracemalloc.is_tracing()
+        start = 0
+        if tracing:
+            start, peak = self._traced_memory()
+            if stack:
+                stack[-1] = max(stack[-1], peak)
+            self._reset_peak()
+        stack.append(start)
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - t
+            peak = stack.pop()
+            if tracing:
+                peak = max(peak, self._traced_memory()[1])
+                if stack:
+                    stack[-1] = max(stack[-1], peak)
+            self._add(name, seconds, peak, peak - start)
+
+    def _traced_memory(self):
+        # the current and the peak traced memory
+        current, peak = tracemalloc.get_traced_memory()
+        return self._offset + current, self._offset + peak
+
+    def _reset_peak(self):
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        else:
+            # before Python 3.9: the traces are dropped, and their size
+            # is kept as an offset (so their release is not seen)
+            self._offset += tracemalloc.get_traced_memory()[0]
+            tracemalloc.clear_traces()
+
+    def _entry(self, name):
+        # the stages are listed in the order of their first start
+        with self._lock:
+            return self._stages.setdefault(
+                name, {'calls': 0, 'seconds': 0.0, 'peak': 0, 'delta': 0})
+
+    def _add(self, name, seconds, peak, delta):
+        entry = self._entry(name)
+        with self._lock:
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+            entry['peak'] = max(entry['peak'], peak)
+            entry['delta'] = max(entry['delta'], delta)
+        if self.callback is not None:
+            self.callback(name, seconds, peak)
+
+    def stats(self):
+        with self._lock:
+            return OrderedDict((k, dict(v)) for k, v in self._stages.items())
+
+
+class _NullContext(object):
+    # contextlib.nullcontext() of Python 3.7+, reusable
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+_active = None
+_null = _NullContext()
+
+
+@contextmanager
+def activate(profiler):
+    """
+    Makes 'profiler' the target of stage() in the context
+    (if it is not None), and starts the memory tracing.
+    """
+    global _active
+    if profiler is None:
+        yield None
+        return
+    previous, _active = _active, profiler
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        _active = previous
+        if previous is None:
+            profiler.stop()
+
+
+def enable(profiler):
+    # activate() without a context, until disable()
+    global _active
+    _active = profiler
+    if profiler is not None:
+        profiler.start()
+
+
+def disable():
+    global _active
+    if _active is not None:
+        _active.stop()
+    _active = None
+
+
+def stage(name):
+    # a stage of the active profiler, or a shared no-op context
+    if _active is None:
+        return _null
+    return _active.stage(name)
+
+
+def profiled(name):
+    """
+    Decorator: the calls of the function are stages, and its
+    'profiler' keyword argument is activated for the call.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, profiler=None, **kwargs):
+            with activate(profiler), stage(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def staged(name):
+    """
+    Decorator: the calls of the function are stages.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -3,8 +3,9 @@
 import os
 import sys
 from contextlib import contextmanager, ContextDecorator
+from functools import lru_cache
 from gc import collect as garbage_collector
-from contracts import contract, new_contract
+from tempfile import mkstemp
 import numpy as np
 
 
@@ -16,8 +17,26 @@ def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
+def _no_decorator(*args, **kwargs):
+    # both @decorator and @decorator(options...), doing nothing
+    if len(args) == 1 and callable(args[0]):
+        return args[0]
+    return lambda f: f
+
+
 try:
-    from numba import jit
+    from numba import jit as numba_jit, prange
+    from numba import config as numba_config
+    jit_enabled = not numba_config.DISABLE_JIT
+
+    def jit(*args, **kwargs):
+        # numba.jit, with the compiled code cached on disk (in
+        # __pycache__), so the kernels are compiled only in the first run
+        kwargs.setdefault('cache', True)
+        if len(args) == 1 and callable(args[0]):
+            return numba_jit(**kwargs)(args[0])
+        return numba_jit(*args, **kwargs)
+
 except ImportError:
     eprint("""
   There is no NUMBA installed!
@@ -25,7 +44,29 @@ except ImportError:
   Try: pip install numba')
   or visit: https://numba.pydata.org/ for details.""")
 
-    def jit(x): return x
+    jit = _no_decorator
+    prange = range
+    jit_enabled = False
+
+# The arguments are checked by PyContracts, unless the DISABLE_CONTRACTS
+# environment variable is set (as for PyContracts itself): then it is
+# not even imported, which shortens the startup. disable_contracts()
+# switches off the checks of the already decorated functions.
+if os.environ.get('DISABLE_CONTRACTS'):
+    contract = _no_decorator
+    new_contract = _no_decorator
+
+    def check(*args, **kwargs):
+        pass
+
+    def disable_contracts():
+        pass
+else:
+    import contracts
+    contract = contracts.contract
+    new_contract = contracts.new_contract
+    check = contracts.check
+    disable_contracts = contracts.disable_all
 
 new_contract('path', os.path.exists)
 new_contract('dir', os.path.isdir)
@@ -97,19 +138,204 @@ def rebin(a, out):
     return out
 
 
+def rebin_stack(a, out):
+    """
+    Single pass version of rebin() for all gray levels:
+    every pixel of the integer image 'a' adds its bilinear weights
+    to the layer selected by its value, out[a[i, j]].
+
+    >>> if True:
+    ...     a = np.array([[0, 1, 1], [2, 2, 0], [1, 0, 2]])
+    ...     out = rebin_stack(a, np.zeros((3, 2, 2)))
+    ...     layers = [rebin((a == k).astype(float), np.zeros((2, 2)))
+    ...               for k in range(3)]
+    ...     print(np.array_equal(out, layers))
+    True
+    """
+    zeros = (0,) * a.ndim
+    return rebin_region(a, out, zeros, a.shape, zeros, out.shape[1:])
+
+
+def rebin_region(a, out, origin, shape, grid_origin, grid_shape):
+    """
+    rebin_stack() of a part of an image: 'a' is the block of an image
+    of 'shape' at 'origin', 'out' is the block of the downscaled grid of
+    'grid_shape' at 'grid_origin'. The weights are calculated in the
+    global coordinates, and the contributions outside of 'out' are
+    dropped, so the blocks are identical to the same part of the whole
+    stack, if 'a' covers every pixel contributing to 'out'.
+    Images and volumes are supported, volumes get trilinear weights.
+
+    >>> if True:
+    ...     a = np.random.RandomState(0).randint(0, 3, (11, 13))
+    ...     full = rebin_stack(a, np.zeros((3, 5, 6)))
+    ...     part = rebin_region(a[2:9, 4:], np.zeros((3, 2, 3)),
+    ...                         (2, 4), a.shape, (2, 3), (5, 6))
+    ...     print(np.array_equal(part, full[:, 2:4, 3:6]))
+    True
+
+    A volume of a single slice is the same as the image:
+
+    >>> if True:
+    ...     volume = rebin_stack(a[None], np.zeros((3, 1, 5, 6)))
+    ...     print(np.array_equal(volume[:, 0], full))
+    True
+    """
+    if a.ndim == 3:
+        return _rebin_region3(a, out, tuple(origin), tuple(shape),
+                              tuple(grid_origin), tuple(grid_shape))
+    return _rebin_region2(a, out, tuple(origin), tuple(shape),
+                          tuple(grid_origin), tuple(grid_shape))
+
+
 @jit
-def dither_FS(image, levels=None, dtype=np.uint):
+def _rebin_region2(a, out, origin, shape, grid_origin, grid_shape):
+    I, J = shape
+    X, Y = grid_shape
+    K, X_, Y_ = out.shape
+    out.fill(0)
+    for i in range(a.shape[0]):
+        for j in range(a.shape[1]):
+            k = a[i, j]
+            U = float(i + origin[0]) * X / I
+            V = float(j + origin[1]) * Y / J
+            u = int(U)
+            v = int(V)
+            f1_ = (U-u)
+            f2_ = (V-v)
+            f1 = 1.0 - f1_
+            f2 = 1.0 - f2_
+            u -= grid_origin[0]
+            v -= grid_origin[1]
+            inside_u = 0 <= u < X_
+            inside_v = 0 <= v < Y_
+            inside_u1 = 0 <= u+1 < X_
+            inside_v1 = 0 <= v+1 < Y_
+
+            if inside_u and inside_v:
+                out[k, u, v] += f1*f2
+            if inside_u1 and inside_v:
+                out[k, u+1, v] += f1_*f2
+            if inside_u and inside_v1:
+                out[k, u, v+1] += f1*f2_
+            if inside_u1 and inside_v1:
+                out[k, u+1, v+1] += f1_*f2_
+    return out
 
-    if levels is None:
-        levels = image.max() + 1
-    result = np.floor(image).astype(np.float)
-    error = image - result
-    w, h = image.shape
+
+@jit
+def _add_trilinear(out, k, i, j, n, shape, grid_shape, grid_origin):
+    # adds the trilinear weights of the voxel (i, j, n) of a volume
+    # of 'shape' to the layer k of the block of the grid at 'grid_origin'
+    position = (i, j, n)
+    base = [0, 0, 0]
+    frac = [0.0, 0.0, 0.0]
+    for axis in range(3):
+        U = float(position[axis]) * grid_shape[axis] / shape[axis]
+        base[axis] = int(U) - grid_origin[axis]
+        frac[axis] = U - int(U)
+    for du in range(2):
+        u = base[0] + du
+        if u < 0 or u >= out.shape[1]:
+            continue
+        fu = frac[0] if du else 1.0 - frac[0]
+        for dv in range(2):
+            v = base[1] + dv
+            if v < 0 or v >= out.shape[2]:
+                continue
+            fv = frac[1] if dv else 1.0 - frac[1]
+            for dw in range(2):
+                w = base[2] + dw
+                if w < 0 or w >= out.shape[3]:
+                    continue
+                fw = frac[2] if dw else 1.0 - frac[2]
+                out[k, u, v, w] += fu * fv * fw
+
+
+@jit
+def _rebin_region3(a, out, origin, shape, grid_origin, grid_shape):
+    out.fill(0)
+    for i in range(a.shape[0]):
+        for j in range(a.shape[1]):
+            for n in range(a.shape[2]):
+                _add_trilinear(out, a[i, j, n],
+                               i + origin[0], j + origin[1], n + origin[2],
+                               shape, grid_shape, grid_origin)
+    return out
+
+
+@jit
+def _rebin_pixels3(idx, shape, out):
+    _, J, N = shape
+    out.fill(0)
+    layer = out.reshape((1,) + out.shape)
+    for n in range(len(idx)):
+        _add_trilinear(layer, 0,
+                       idx[n] // (J * N), (idx[n] // N) % J, idx[n] % N,
+                       shape, out.shape, (0, 0, 0))
+    return out
+
+
+def rebin_pixels(idx, shape, out):
+    """
+    rebin() of a binary image or volume, given by the flat indices of
+    its nonzero pixels, so the cost is proportional to the pixel count.
+
+    >>> if True:
+    ...     a = np.zeros((5, 7))
+    ...     a[[0, 2, 4], [3, 6, 1]] = 1
+    ...     out = rebin_pixels(np.flatnonzero(a), a.shape, np.zeros((2, 3)))
+    ...     print(np.array_equal(out, rebin(a, np.zeros((2, 3)))))
+    True
+    >>> if True:
+    ...     a = np.random.RandomState(0).randint(0, 2, (4, 5, 7))
+    ...     out = rebin_pixels(np.flatnonzero(a), a.shape, np.zeros((2, 2, 3)))
+    ...     stack = rebin_stack(a, np.zeros((2, 2, 2, 3)))
+    ...     print(np.allclose(out, stack[1]))
+    True
+    """
+    if len(shape) == 3:
+        return _rebin_pixels3(idx, tuple(shape), out)
+    return _rebin_pixels2(idx, tuple(shape), out)
+
+
+@jit
+def _rebin_pixels2(idx, shape, out):
+    I, J = shape
+    X, Y = out.shape
+    out.fill(0)
+    for n in range(len(idx)):
+        i = idx[n] // J
+        j = idx[n] % J
+        U = float(i) * X / I
+        V = float(j) * Y / J
+        u = int(U)
+        v = int(V)
+        f1_ = (U-u)
+        f2_ = (V-v)
+        f1 = 1.0 - f1_
+        f2 = 1.0 - f2_
+        out[u, v] += f1*f2
+
+        if u+1 < X:
+            out[u+1, v] += f1_*f2
+        if v+1 < Y:
+            out[u, v+1] += f1*f2_
+        if (u+1 < X) and (v+1 < Y):
+            out[u+1, v+1] += f1_*f2_
+    return out
+
+
+@jit(nopython=True)
+def _diffuse(result, error):
+    # Floyd-Steinberg error diffusion of the fractional parts 'error'
+    # into the integer parts 'result', in place
+    w, h = result.shape
     A, B, C, D = 7./16, 3./16, 5./16, 1./16
     e = 0
     for i in range(w):
         for j in range(h):
-            e = error[i][j]
+            e = error[i, j]
             if e >= 1:
                 result[i, j] += 1
                 e -= 1.0
@@ -121,6 +347,46 @@ def dither_FS(image, levels=None, dtype=np.uint):
                 error[i+1, j] += C*e
             if i+1 < w and j+1 < h:
                 error[i+1, j+1] += D*e
+
+
+@jit(nopython=True, parallel=True)
+def _diffuse_bands(result, error, band, overlap):
+    # The bands of rows are diffused independently, in parallel.
+    # Every band starts 'overlap' rows earlier, so the error entering
+    # the band is about the same as in the serial version. Only the
+    # error of these rows matters, and the error is never written.
+    n = result.shape[0]
+    for b in prange((n + band - 1) // band):
+        r0 = b * band
+        r1 = min(r0 + band, n)
+        s0 = max(r0 - overlap, 0)
+        r = result[s0:r1].copy()
+        _diffuse(r, error[s0:r1].copy())
+        result[r0:r1] = r[r0 - s0:]
+
+
+def dither_FS(image, levels=None, dtype=np.uint, band=None, overlap=8):
+    """
+    Floyd-Steinberg dithering. With 'band', the image is processed
+    in bands of 'band' rows in parallel. The error is not carried
+    over between the bands, which breaks the serial dependency;
+    instead, the diffusion of every band starts 'overlap' rows
+    earlier, which hides the seams.
+
+    >>> image = np.random.RandomState(0).rand(64, 48) * 3
+    >>> a = dither_FS(image, levels=4, band=16)
+    >>> b = dither_FS(image, levels=4)
+    >>> print(np.array_equal(a[:16], b[:16]), abs(a.mean() - b.mean()) < 0.005)
+    True True
+    """
+    if levels is None:
+        levels = image.max() + 1
+    result = np.floor(image).astype(np.float64)
+    error = image - result
+    if band is None:
+        _diffuse(result, error)
+    else:
+        _diffuse_bands(result, error, band, overlap)
     return np.clip(result.reshape(image.shape), 0, levels-1).astype(dtype)
 
 
@@ -130,16 +396,91 @@ def dither_basic(image, levels=None, dtype=np.uint):
         levels = int(image.max())+1
     result = np.floor(image).ravel()
     error = np.diff(np.floor(np.cumsum(image.ravel() - result))
-                    ).astype(np.bool).astype(np.float32)
+                    ).astype(bool).astype(np.float32)
     result[1:] += error
     return np.clip(result.reshape(image.shape), 0, levels-1).astype(dtype)
 
 
-@collect()
+def bayer_matrix(order):
+    """
+    Threshold matrix of ordered dithering, of 2**order x 2**order
+    elements, with every threshold in (0, 1) exactly once.
+
+    >>> bayer_matrix(1) * 4
+    array([[0.5, 2.5],
+           [3.5, 1.5]])
+    """
+    m = np.zeros((1, 1))
+    for _ in range(order):
+        m = np.block([[4 * m, 4 * m + 2], [4 * m + 3, 4 * m + 1]])
+    return (m + 0.5) / m.size
+
+
+@lru_cache(maxsize=None)
+def blue_noise(size=64, seed=0):
+    """
+    Threshold matrix of blue noise dithering: high-pass filtered
+    white noise, ranked to uniform thresholds in (0, 1), so it tiles
+    without low frequency patterns (a cheap variant of the
+    void-and-cluster method).
+
+    >>> m = blue_noise(16)
+    >>> print(m.shape, np.allclose(np.sort(m, axis=None),
+    ...                            np.sort(bayer_matrix(4), axis=None)))
+    (16, 16) True
+    """
+    noise = np.random.RandomState(seed).rand(size, size)
+    f = np.fft.fftfreq(size)
+    r2 = f[:, None]**2 + f[None, :]**2
+    sigma = 0.1
+    noise = np.fft.ifft2(np.fft.fft2(noise) *
+                         (1 - np.exp(-r2 / (2 * sigma**2)))).real
+    ranks = np.empty(noise.size)
+    ranks[np.argsort(noise, axis=None)] = np.arange(noise.size)
+    m = ((ranks + 0.5) / noise.size).reshape(size, size)
+    m.setflags(write=False)
+    return m
+
+
+def dither_ordered(image, levels=None, dtype=np.uint, thresholds=None):
+    """
+    Ordered dithering with the tiled threshold matrix (default:
+    bayer_matrix(3)), vectorized, so it is fast even without numba.
+    Like error diffusion, it preserves the mean gray value, but
+    only locally, within the area of the matrix.
+
+    >>> dither_ordered(np.full((4, 4), 1.25), levels=4, dtype=np.uint8)
+    array([[1, 1, 1, 1],
+           [2, 1, 2, 1],
+           [1, 1, 1, 1],
+           [2, 1, 2, 1]], dtype=uint8)
+    """
+    if levels is None:
+        levels = int(image.max())+1
+    if thresholds is None:
+        thresholds = bayer_matrix(3)
+    n, m = thresholds.shape
+    w, h = image.shape
+    # one band of rows at a time, the buffer stays in the cache
+    t = np.tile(thresholds, (1, -(-h // m)))[:, :h]
+    buffer = np.empty((n, h))
+    result = np.empty((w, h), dtype=dtype)
+    for i in range(0, w, n):
+        b = buffer[:min(n, w - i)]
+        np.add(image[i:i + n], t[:len(b)], out=b)
+        np.floor(b, out=b)
+        result[i:i + n] = np.clip(b, 0, levels-1, out=b)
+    return result
+
+
 @contract(image='array[NxM](float32)|array[NxM](float64)',
           levels='None|int,>1')
 def dither(image, levels=None, method='floyd', dtype=np.uint8):
     """
+    Dithering to 'levels' integer levels: 'floyd' (also 'fs',
+    'floyd-steinberg'), 'parallel' (Floyd-Steinberg in bands of rows),
+    'ordered' (Bayer), 'blue-noise' or 'basic'.
+
     >>> dither(np.arange(16).reshape(4,4)/4.0,levels=4)
     array([[0, 0, 0, 1],
            [1, 1, 1, 2],
@@ -150,15 +491,34 @@ def dither(image, levels=None, method='floyd', dtype=np.uint8):
            [1, 1, 2, 2],
            [2, 2, 2, 3],
            [3, 3, 3, 3]], dtype=uint8)
-
+    >>> for method in dither_methods:
+    ...     x = np.linspace(0, 3, 64 * 64).reshape(64, 64)
+    ...     print(method, abs(dither(x, 4, method).mean() - x.mean()) < 0.01)
+    floyd True
+    parallel True
+    ordered True
+    blue-noise True
+    basic True
     """
     if method in ['floyd', 'fs', 'floyd-steinberg']:
         # Floyd steinberg dithering
         return dither_FS(image, levels, dtype)
+    if method == 'parallel':
+        return dither_FS(image, levels, dtype, band=DITHER_BAND)
+    if method == 'ordered':
+        return dither_ordered(image, levels, dtype)
+    if method == 'blue-noise':
+        return dither_ordered(image, levels, dtype, blue_noise())
     # basic dithering
     return dither_basic(image, levels, dtype)
 
 
+dither_methods = ['floyd', 'parallel', 'ordered', 'blue-noise', 'basic']
+
+# rows per band of the 'parallel' dithering
+DITHER_BAND = 64
+
+
 @contextmanager
 @contract(f='file|filename|str')
 def delete_file_ctx(f):
@@ -197,14 +557,46 @@ def delete_file_ctx(f):
     False
     """
 
-    yield
-    if hasattr(f, 'read'):
-        name = f.name
-        if not f.closed:
-            f.close()
-        os.remove(name)
-    else:
-        os.remove(f)
+    try:
+        yield
+    finally:
+        if hasattr(f, 'read'):
+            name = f.name
+            if not f.closed:
+                f.close()
+            os.remove(name)
+        else:
+            os.remove(f)
+
+
+@contextmanager
+@contract(shape='tuple', tempdir='None|dir')
+def array_ctx(shape, dtype=np.float32, tempdir=None):
+    """
+    Zero-initialized array, which is a memory mapped temporary file
+    in 'tempdir', if it is given. The file is deleted after the context.
+
+    >>> if True:
+    ...     import tempfile
+    ...     d = tempfile.mkdtemp()
+    ...     with array_ctx((2, 3), tempdir=d) as a:
+    ...         a += 1
+    ...         print(type(a).__name__, a.sum(), len(os.listdir(d)))
+    ...     print(len(os.listdir(d)))
+    memmap 6.0 1
+    0
+    >>> with array_ctx((2, 3)) as a:
+    ...     print(type(a).__name__, a.dtype)
+    ndarray float32
+    """
+    if tempdir is None:
+        yield np.zeros(shape=shape, dtype=dtype)
+        return
+
+    fd, fn = mkstemp(prefix='TMO4CT_', suffix='.raw', dir=tempdir)
+    os.close(fd)
+    with delete_file_ctx(fn):
+        yield np.memmap(fn, dtype=dtype, mode='w+', shape=shape)
 
 
 if __name__ == '__main__':
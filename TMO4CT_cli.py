@@ -3,20 +3,24 @@
 # standard python libraries
 import os
 import sys
+import json
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 from gc import collect as garbage_collector
+from tempfile import TemporaryDirectory
 
 # Additional libraries
 import numpy as np   # http://www.numpy.org/
-import skimage      # http://scikit-image.org/
-import skimage.color
-
-# https://andreacensi.github.io/contracts
-from contracts import contract, check
-import imageio
-import tifffile as tiff
-
-from TMO4CT.tools import eprint, dither
-from TMO4CT.algorithm import tone_mapping
+# scikit-image, imageio and tifffile are imported when they are needed,
+# for a faster startup
+
+# https://andreacensi.github.io/contracts (see TMO4CT.tools)
+from TMO4CT.tools import contract, check, disable_contracts
+from TMO4CT.tools import eprint, dither, dither_methods
+from TMO4CT.algorithm import tone_mapping, quantile_bins, bin_coordinates
+from TMO4CT.cache import kernel_cache
+from TMO4CT.planner import memory_plan, parse_bytes, print_plan
+from TMO4CT.profiling import Profiler, enable, disable, stage
 from TMO4CT import __version__, __description__, __title__, __reference__, __bibtex__
 # Libraries implemented for the article
 # try:
@@ -36,6 +40,13 @@ def if_not_none(a, b):
     return b
 
 
+def dither_slices(image, **kwargs):
+    # volumes are dithered slice by slice
+    if image.ndim == 3:
+        return np.stack([dither(s, **kwargs) for s in image])
+    return dither(image, **kwargs)
+
+
 @contract(filename='filename', ftype='None|str')
 def read_image(filename, ftype=None):
     if ftype is None or ftype == 'autodetect':
@@ -52,14 +63,283 @@ def read_image(filename, ftype=None):
         eprint('DCM2HDR is able to convert DICOMs to 16bit tiff/png.')
         sys.exit(-1)
     elif ftype == 'image/tiff':
-        img = tiff.imread(filename)
+        import tifffile
+        img = tifffile.imread(filename)
         return img, 'image'
     elif ftype.startswith('image/'):
+        import imageio
         return imageio.imread(filename), 'image'
     eprint('File format is not detected or not supported.')
     sys.exit(-1)
 
 
+def write_image(filename, image, volume=False):
+    # volumes are written as multi-page TIFF files
+    if volume:
+        import tifffile
+        tifffile.imwrite(filename, image)
+    else:
+        import imageio
+        imageio.imsave(filename, image)
+
+
+# the channel of the luminance in the color spaces, and its range
+color_channel_mapping = {
+    'HSV': 2,
+    'YIQ': 0,
+    'YCbCr': 0,
+    'YPbPr': 0,
+    'YUV': 0}
+color_channel_scale_factor = {
+    'HSV': 1.0,
+    'YIQ': 1.0,
+    'YCbCr': 235.,
+    'YPbPr': 1.0,
+    'YUV': 1.0}
+
+
+def output_path(path, options):
+    # next to the input, unless an output directory is given
+    dirname, filename = os.path.split(path)
+    fileroot, ext = os.path.splitext(filename)
+    return os.path.join(if_not_none(dirname, options.outdir),
+                        fileroot + options.postfix + options.outtype)
+
+
+def process_file(path, output_file, options):
+    bins = options.bins
+    check('filename', path)
+    if options.verbose > 0:
+        eprint('\nFile: {}'.format(path))
+    # opening input file, and preprocessing
+    with stage('read'):
+        image, itype = read_image(path, options.filetype)
+
+    if options.volume and image.ndim != 3:
+        eprint('The input is not a volume!')
+        sys.exit(1)
+    multi_channel = len(image.shape) > 2 and not options.volume
+
+    # ~# color space conversion, if necessary
+    hidden_gray = False
+    if multi_channel:
+        import skimage.color  # also for the conversion of the output
+        if skimage.__version__ < '0.14.0':
+            eprint('Remark: Color conversion in skimage is buggy'
+                   + ' before 0.14. Use at least 0.14.')
+            sys.exit(1)
+        hidden_gray = True
+        for ch in range(1, image.shape[-1]):
+            hidden_gray = (hidden_gray and
+                           np.all(image[..., 0] == image[..., ch]))
+        if not hidden_gray:
+            with stage('color conversion'):
+                data = skimage.color.convert_colorspace(
+                    image, 'RGB', options.colorspace)
+            color_channel = color_channel_mapping[options.colorspace]
+            img = (data[..., color_channel] /
+                   color_channel_scale_factor[options.colorspace])
+        else:
+            image = image[..., 0]
+            img = image
+            multi_channel = False
+    else:
+        img = image
+
+    m = if_not_none(img.min(), options.dynamic_bottom)
+    M = if_not_none(img.max(), options.dynamic_top)
+    img = np.clip(img, m, M)
+
+    gain_limits = options.climit
+    bin_centers = None
+
+    with stage('binning'):
+        if bins <= 1:  # Use all
+            img = img.astype(np.float32).reshape(img.shape)
+            bins = int(img.max())+1
+            dtype = np.uint8 if bins < 255 else np.uint16
+            binned = img.astype(dtype)
+        elif options.binning == 'quantile':
+            # the original gray values are mapped through the bin
+            # centers in tone_mapping()
+            img = img.astype(np.float32)
+            bin_centers = quantile_bins(img, bins)
+            bins = len(bin_centers)
+            dtype = np.uint8 if bins < 255 else np.uint16
+            binned = dither_slices(bin_coordinates(img, bin_centers),
+                                   levels=bins,
+                                   method=options.dither,
+                                   dtype=dtype)
+        else:
+            img = ((img - m) * (float(bins-1) /
+                                float(M - m))).astype(np.float32)
+            dtype = np.uint8 if bins < 255 else np.uint16
+            binned = dither_slices(img, levels=bins,
+                                   method=options.dither,
+                                   dtype=dtype)
+
+    if options.verbose > 1:
+        eprint('    Image dimensions     : {}'.format(image.shape))
+        if multi_channel:
+            eprint('    Color space, channel :' +
+                   ' {}, #{}'.format(options.colorspace, color_channel))
+        else:
+            eprint('    Color space, channel : single channel data')
+        eprint('    Dynamic range        : {} - {} '.format(m, M))
+        if bin_centers is not None:
+            eprint('    Quantile bins        : {}'.format(bins))
+
+    if options.verbose > 2:
+        eprint('\n    Command line: ', ' '.join(sys.argv))
+    # main processing
+
+    image = None
+
+    fft_precision = np.float32 if options.single_precision else np.float64
+    plan = {'downscale': options.downscale,
+            'batch_size': options.batch_size,
+            'storage': options.storage,
+            'tempdir': options.tempdir,
+            'chunk_bytes': 64 * 2**20,
+            'chunk_pixels': 2**18}
+    if options.max_memory is not None:
+        # the color channels are kept for the output
+        plan = memory_plan(img.shape,
+                           np.count_nonzero(np.bincount(binned.ravel())),
+                           options.max_memory,
+                           downscale=options.downscale,
+                           batch_size=options.batch_size,
+                           storage=options.storage,
+                           tempdir=options.tempdir,
+                           backend=options.backend,
+                           fft_precision=fft_precision,
+                           streaming=options.streaming,
+                           workers=options.workers,
+                           overhead=data.nbytes if multi_channel else 0)
+        if options.verbose > 1:
+            print_plan(plan)
+
+    result = tone_mapping(img,
+                          binned,
+                          verbosity=options.verbose,
+                          GAIN=gain_limits,
+                          exps=options.exps,
+                          factors=options.factors,
+                          MAX=options.MAX,
+                          R_cutoff=options.R_cutoff,
+                          downscale=plan['downscale'],
+                          distance_metric=options.distance,
+                          tempdir=plan['tempdir'],
+                          streaming=options.streaming,
+                          workers=options.workers,
+                          batch_size=plan['batch_size'],
+                          backend=options.backend,
+                          tile_size=options.tile_size,
+                          spacing=options.spacing,
+                          storage=plan['storage'],
+                          bin_centers=bin_centers,
+                          chunk_bytes=plan['chunk_bytes'],
+                          chunk_pixels=plan['chunk_pixels'],
+                          fft_precision=fft_precision
+                          )
+
+    with stage('dithering'):
+        result *= 255. / result.max()
+        result = dither_slices(result, levels=256, method=options.dither,
+                               dtype=np.uint8)
+
+    img = None
+    binned = None
+    gain_limits = None
+
+    if options.verbose > 2:
+        eprint('    Kernel cache         : {hits} hits, '
+               '{misses} misses'.format(**kernel_cache.stats()))
+    if options.verbose > 1:
+        eprint('    Output file: {}'.format(output_file))
+    if options.volume:
+        with stage('write'):
+            write_image(output_file, result, volume=True)
+    elif not multi_channel:
+        if hidden_gray:
+            result = np.dstack((result, result, result))
+        with stage('write'):
+            write_image(output_file, result)
+
+    # multichannel
+    else:
+        data[..., color_channel_mapping[options.colorspace]] = result * \
+            color_channel_scale_factor[options.colorspace] / result.max()
+
+        result = None
+        image = None
+        img = None
+
+        # in blocks of rows of the interpolation chunk size
+        rows = max(1, plan['chunk_pixels'] // data.shape[1])
+        result = []
+        with stage('color conversion'):
+            for r in range(0, len(data), rows):
+                result.append(skimage.color.convert_colorspace(
+                    data[r:r + rows],
+                    options.colorspace,
+                    'RGB'))
+        data = None
+        # the image writers only take integer RGB images
+        rgb = np.concatenate(result)
+        result = None
+        rgb = np.clip(rgb * 255. + 0.5, 0, 255).astype(np.uint8)
+        with stage('write'):
+            write_image(output_file, rgb)
+
+
+def run_file(path, output_file, options):
+    """
+    process_file(), with its errors (also the exits with an error
+    message) returned, so the other files of the batch are processed,
+    the profile of the file (with --profile), and the use of the
+    kernel cache.
+    """
+    profiler = Profiler() if options.profile else None
+    before = kernel_cache.stats()
+    error = None
+    enable(profiler)
+    try:
+        process_file(path, output_file, options)
+    except SystemExit as e:
+        error = 'exit status {}'.format(e.code)
+    except Exception as e:
+        if options.verbose > 2:
+            traceback.print_exc()
+        error = '{}: {}'.format(type(e).__name__, e)
+    finally:
+        disable()
+    if error is not None:
+        eprint('Processing of {} failed: {}'.format(path, error))
+        # the traceback could keep the arrays of the file alive
+        garbage_collector()
+    after = kernel_cache.stats()
+    return {'error': error,
+            'profile': None if profiler is None else profiler.stats(),
+            'kernel_cache': {k: after[k] - before[k]
+                             for k in ('hits', 'disk_hits', 'misses')}}
+
+
+def init_worker(options):
+    # the settings of the process (and of the workers of --jobs)
+    kernel_cache.max_bytes = int(options.cache_size * 2**20)
+    kernel_cache.cache_dir = options.cache_dir
+    if options.no_contracts:
+        disable_contracts()
+
+
+def run_job(path, output_file, options):
+    # run_file() in a worker of --jobs (the initializer of the process
+    # pools needs Python 3.7)
+    init_worker(options)
+    return run_file(path, output_file, options)
+
+
 def main():
     from optparse import OptionParser
 
@@ -166,6 +446,27 @@ def main():
                       help='number of bins (default: 0 - no binning)',
                       default=0)
 
+    parser.add_option('--binning',
+                      action='store',
+                      type='choice',
+                      choices=['uniform', 'quantile'],
+                      dest='binning',
+                      help='bin placement: "uniform" in the dynamic ' +
+                      'range, or at the "quantile"s of the image ' +
+                      'histogram (default: uniform)',
+                      default='uniform')
+
+    parser.add_option('--dither',
+                      action='store',
+                      type='choice',
+                      choices=dither_methods,
+                      dest='dither',
+                      help='dithering of the binned input and of the ' +
+                      'output: "floyd", "parallel" (Floyd-Steinberg ' +
+                      'in bands of rows), "ordered", "blue-noise" or ' +
+                      '"basic" (default: floyd)',
+                      default='floyd')
+
     parser.add_option('-s', '--color_space',
                       action='store',
                       type='string',
@@ -196,6 +497,129 @@ def main():
                       '"eucledian", "maximum", "manhattan"' +
                       'or any 0<p<inf float number.')
 
+    parser.add_option('--workers',
+                      action='store',
+                      type='int',
+                      dest='workers',
+                      help='number of threads for the FFT convolution ' +
+                      'and interpolation, -1: all cores (default: 1)',
+                      default=1)
+
+    parser.add_option('-j', '--jobs',
+                      action='store',
+                      type='int',
+                      dest='jobs',
+                      help='number of files processed in parallel ' +
+                      'processes, -1: all cores (default: 1); ' +
+                      'the memory budget is per process',
+                      default=1)
+
+    parser.add_option('--batch-size',
+                      action='store',
+                      type='int',
+                      dest='batch_size',
+                      help='number of layers per FFT batch ' +
+                      '(default: automatic)')
+
+    parser.add_option('--backend',
+                      action='store',
+                      type='choice',
+                      choices=['fft', 'dct', 'direct', 'approximate'],
+                      dest='backend',
+                      help='convolution backend: "fft", "dct", ' +
+                      '"direct" (needs --R-cutoff) or ' +
+                      '"approximate" (sum of Gaussians) (default: fft)',
+                      default='fft')
+
+    parser.add_option('--volume',
+                      action='store_true',
+                      dest='volume',
+                      help='3D input (e.g. multi-page TIFF) is a volume, ' +
+                      'not a color image; the output is a TIFF volume',
+                      default=False)
+
+    parser.add_option('--spacing',
+                      action='store',
+                      type='string',
+                      dest='spacing',
+                      help='voxel size along the axes of the volume, ' +
+                      'e.g. "2.5,1,1" (default: isotropic)')
+
+    parser.add_option('--tile-size',
+                      action='store',
+                      type='int',
+                      dest='tile_size',
+                      help='process the image in tiles of this size ' +
+                      '(needs --R-cutoff, default: no tiles)')
+
+    parser.add_option('--storage',
+                      action='store',
+                      type='choice',
+                      choices=['float16', 'uint16'],
+                      dest='storage',
+                      help='store the histogram stack in half the ' +
+                      'memory: "float16" or "uint16" (fixed point) ' +
+                      '(default: float32)')
+
+    parser.add_option('--single-precision',
+                      action='store_true',
+                      dest='single_precision',
+                      help='single precision (float32/complex64) ' +
+                      'convolution',
+                      default=False)
+
+    parser.add_option('--tempdir',
+                      action='store',
+                      type='string',
+                      dest='tempdir',
+                      help='store the histogram stack in memory mapped ' +
+                      'files in this directory (default: in memory)')
+
+    parser.add_option('--max-memory',
+                      action='store',
+                      type='string',
+                      dest='max_memory',
+                      help='memory budget, e.g. "2G": the downscale ' +
+                      'factor (unless -x is given), the batch size, ' +
+                      'the chunks and the storage of the histogram ' +
+                      'stack are chosen to fit (default: no limit)')
+
+    parser.add_option('--profile',
+                      action='store',
+                      type='string',
+                      dest='profile',
+                      help='write the time and the peak memory of the ' +
+                      'processing stages into this JSON file')
+
+    parser.add_option('--no-contracts',
+                      action='store_true',
+                      dest='no_contracts',
+                      help='skip the runtime argument checks ' +
+                      '(PyContracts) of the functions, e.g. of the ' +
+                      'dithering; with the DISABLE_CONTRACTS ' +
+                      'environment variable PyContracts is not loaded',
+                      default=False)
+
+    parser.add_option('--streaming',
+                      action='store_true',
+                      dest='streaming',
+                      help='two-pass, bounded memory CDF computation',
+                      default=False)
+
+    parser.add_option('--cache-dir',
+                      action='store',
+                      type='string',
+                      dest='cache_dir',
+                      help='directory for caching kernel spectra ' +
+                      'between runs (default: no disk cache)')
+
+    parser.add_option('--cache-size',
+                      action='store',
+                      type='float',
+                      dest='cache_size',
+                      help='in-memory kernel cache size in MB (default: 512)',
+                      default=512.)
+
     parser.add_option('--overwrite',
                       action='store_true',
                       dest='overwrite',
@@ -208,24 +632,15 @@ def main():
                       default=False,
                       help='print citation information')
 
-    color_channel_mapping = {
-        'HSV': 2,
-        'YIQ': 0,
-        'YCbCr': 0,
-        'YPbPr': 0,
-        'YUV': 0}
-    color_channel_scale_factor = {
-        'HSV': 1.0,
-        'YIQ': 1.0,
-        'YCbCr': 235.,
-        'YPbPr': 1.0,
-        'YUV': 1.0}
-
     (options, args) = parser.parse_args()
 
     # Test of input parameters
     check('int, >=0', options.bins, 'number of bins')
     check('float, >0', options.climit, 'contrast limit')
+    check('float, >=0', options.cache_size, 'cache size')
+    check('int, (>0|=-1)', options.workers, 'number of workers')
+    check('None|(int, >0)', options.batch_size, 'batch size')
+    check('int, (>0|=-1)', options.jobs, 'number of jobs')
 
     if options.cite:
         print('Reference for this software:')
@@ -248,144 +663,94 @@ def main():
         eprint('The number of exponents and scaling factors must match!')
         sys.exit(0)
 
-    for path in args:
-        check('filename', path)
+    if options.tempdir is not None:
+        check('dir', options.tempdir, 'temporary directory')
 
-        if options.verbose > 0:
-            eprint('\nFile: {}'.format(path))
-        garbage_collector()
-        dirname, filename = os.path.split(path)
-        fileroot, ext = os.path.splitext(filename)
+    if options.max_memory is not None:
+        options.max_memory = parse_bytes(options.max_memory)
+        if options.tile_size is not None:
+            eprint('The memory budget cannot be combined with tiles.')
+            sys.exit(1)
 
-        if not options.outtype.startswith('.'):
-            options.outtype = '.' + options.outtype
-        if options.outdir is None:
-            options.outdir = dirname
+    if options.spacing is not None:
+        try:
+            options.spacing = tuple(float(h)
+                                    for h in options.spacing.split(','))
+        except ValueError:
+            eprint('The spacing must be comma separated numbers!')
+            sys.exit(1)
+        if len(options.spacing) != 3 or min(options.spacing) <= 0:
+            eprint('The spacing needs 3 positive values!')
+            sys.exit(1)
+        if not options.volume:
+            eprint('The spacing is only used for volumes (--volume).')
+            sys.exit(1)
 
-        output_file = os.path.join(
-            options.outdir,
-            fileroot + options.postfix + options.outtype)
+    if not options.outtype.startswith('.'):
+        options.outtype = '.' + options.outtype
+    if options.volume and options.outtype not in ('.tif', '.tiff'):
+        eprint('Volumes can be saved only in TIFF format (-o tiff).')
+        sys.exit(1)
 
+    # the existing outputs are skipped, the other files are processed
+    todo = []
+    skipped = []
+    for path in args:
+        output_file = output_path(path, options)
         if os.path.exists(output_file) and (not options.overwrite):
-            eprint('Output file already exists!')
-            eprint('Use "--overwrite", if you want to overwrite it.')
-            sys.exit(0)
-
-        # opening input file, and preprocessing
-        image, itype = read_image(path, options.filetype)
-
-        multi_channel = len(image.shape) > 2
-
-        # ~# color space conversion, if necessary
-        hidden_gray = False
-        if multi_channel:
-            if skimage.__version__ < '0.14.0':
-                eprint('Remark: Color conversion in skimage is buggy'
-                       + ' before 0.14. Use at least 0.14.')
-                sys.exit(1)
-            hidden_gray = True
-            for ch in range(1, image.shape[-1]):
-                hidden_gray = (hidden_gray and
-                               np.all(image[..., 0] == image[..., ch]))
-            if not hidden_gray:
-                data = skimage.color.convert_colorspace(image,
-                                                        'RGB',
-                                                        options.colorspace)
-                color_channel = color_channel_mapping[options.colorspace]
-                img = (data[..., color_channel] /
-                       color_channel_scale_factor[options.colorspace])
-            else:
-                image = image[..., 0]
-                img = image
-                multi_channel = False
-        else:
-            img = image
-
-        m = if_not_none(img.min(), options.dynamic_bottom)
-        M = if_not_none(img.max(), options.dynamic_top)
-        img = np.clip(img, m, M)
-
-        gain_limits = options.climit
-
-        if options.bins <= 1:  # Use all
-            img = img.astype(np.float32).reshape(img.shape)
-            options.bins = int(img.max())+1
-            dtype = np.uint8 if options.bins < 255 else np.uint16
-            binned = img.astype(dtype)
-        else:
-            img = ((img - m) *
-                   (float(options.bins-1) / float(M - m))).astype(np.float32)
-            dtype = np.uint8 if options.bins < 255 else np.uint16
-            binned = dither(img, levels=options.bins, method='fs', dtype=dtype)
-
-        if options.verbose > 1:
-            eprint('    Image dimensions     : {}'.format(image.shape))
-            if multi_channel:
-                eprint('    Color space, channel :' +
-                       ' {}, #{}'.format(options.colorspace, color_channel))
-            else:
-                eprint('    Color space, channel : single channel data')
-            eprint('    Dynamic range        : {} - {} '.format(m, M))
-
-        if options.verbose > 2:
-            eprint('\n    Command line: ', ' '.join(sys.argv))
-        # main processing
-
-        image = None
-
-        garbage_collector()
-
-        result = tone_mapping(img,
-                              binned,
-                              verbosity=options.verbose,
-                              GAIN=gain_limits,
-                              exps=options.exps,
-                              factors=options.factors,
-                              MAX=options.MAX,
-                              R_cutoff=options.R_cutoff,
-                              downscale=options.downscale,
-                              distance_metric=options.distance
-                              )
-
-        result *= 255. / result.max()
-        result = dither(result, levels=256, method='fs', dtype=np.uint8)
-
-        img = None
-        binned = None
-        gain_limits = None
-        garbage_collector()
-
-        if options.verbose > 1:
-            eprint('    Output file: {}'.format(output_file))
-        if not multi_channel:
-            if hidden_gray:
-                result = np.dstack((result, result, result))
-                imageio.imsave(output_file, result)
-            else:
-                imageio.imsave(output_file, result)
-
-        # multichannel
+            eprint('Output file already exists: {}'.format(output_file))
+            skipped.append(path)
         else:
-            data[..., color_channel_mapping[options.colorspace]] = result * \
-                color_channel_scale_factor[options.colorspace] / result.max()
-
-            result = None
-            image = None
-            img = None
-            garbage_collector()
-
-            result = []
-            for d in np.array_split(data, 15):
-                result.append(skimage.color.convert_colorspace(
-                    d,
-                    options.colorspace,
-                    'RGB'))
-            data = None
-            garbage_collector()
-            rgb = np.concatenate(result)
-            result = None
-            garbage_collector()
-            imageio.imsave(output_file, rgb)
+            todo.append((path, output_file))
+    if skipped:
+        eprint('Use "--overwrite", if you want to overwrite {}.'.format(
+            'them' if len(skipped) > 1 else 'it'))
+
+    results = {}
+    jobs = min(os.cpu_count() if options.jobs == -1 else options.jobs,
+               len(todo))
+    if jobs > 1:
+        with TemporaryDirectory() as shared:
+            # the workers share the kernels through the disk cache,
+            # so every kernel is computed only once
+            if options.cache_dir is None:
+                options.cache_dir = shared
+            with ProcessPoolExecutor(jobs) as pool:
+                futures = [(path, pool.submit(run_job, path, output_file,
+                                              options))
+                           for path, output_file in todo]
+                for path, future in futures:
+                    try:
+                        results[path] = future.result()
+                    except Exception as e:  # e.g. a killed worker
+                        eprint('Processing of {} failed: {}'.format(path, e))
+                        results[path] = {'error': str(e),
+                                         'profile': None,
+                                         'kernel_cache': {}}
+    else:
+        init_worker(options)
+        for path, output_file in todo:
+            results[path] = run_file(path, output_file, options)
+
+    failed = [path for path, r in results.items() if r['error'] is not None]
+    if len(args) > 1:
+        eprint('\n{} processed, {} skipped, {} failed'.format(
+            len(results) - len(failed), len(skipped), len(failed)))
+        for path in failed:
+            eprint('    {}: {}'.format(path, results[path]['error']))
+
+    if options.profile:
+        cache = {k: sum(r['kernel_cache'].get(k, 0)
+                        for r in results.values())
+                 for k in ('hits', 'disk_hits', 'misses')}
+        with open(options.profile, 'w') as f:
+            json.dump({'files': {path: r['profile']
+                                 for path, r in results.items()
+                                 if r['error'] is None and r['profile']},
+                       'kernel_cache': cache}, f, indent=2)
+
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
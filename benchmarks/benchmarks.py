@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the stages of the tone mapping, in the format of
+airspeed velocity (asv): the 'time_*' methods are timed for every
+combination of the 'params', after setup(); a NotImplementedError
+in setup() skips the combination.
+They can be run with asv, or with 'python3 -m benchmarks.run'
+(see run.py), which compares the timings with a stored baseline.
+"""
+import os
+from functools import lru_cache
+import numpy as np
+import imageio
+import tifffile
+
+from TMO4CT.algorithm import (mask_generation, get_distance, conv,
+                              kernel_fft, kernel_spectrum, histogram_shape,
+                              tone_mapping)
+from TMO4CT.convolution import backends
+from TMO4CT.tools import dither, rebin_pixels
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                    os.pardir, 'test-data')
+
+# the parameters of the ci-test runs of the command line tool
+ARGS = dict(GAIN=5.0, exps=[1.2], factors=[1.0], MAX=1.0)
+
+# the combinations with a larger histogram stack are skipped
+MAX_STACK = 512 * 2**20
+
+IMAGES = ['ankle', 'ship1k', 'synthetic-512', 'synthetic-1024',
+          'synthetic-2048', 'synthetic-4096']
+
+
+def synthetic_image(size, seed=0):
+    """
+    Deterministic 16 bit CT-like image: air, soft tissue ellipses
+    with bone inclusions in the range of 12 bit CT values, and
+    smooth noise.
+
+    >>> a = synthetic_image(64)
+    >>> a.dtype, a.shape, np.array_equal(a, synthetic_image(64))
+    (dtype('uint16'), (64, 64), True)
+    """
+    random = np.random.RandomState(seed)
+    y, x = np.mgrid[-1:1:size * 1j, -1:1:size * 1j]
+    image = np.full((size, size), 24.0)
+    ellipses = [(0.0, 0.0, 0.85, 0.7, 0.0, 1040.0)]
+    for _ in range(12):
+        cx, cy = random.uniform(-0.5, 0.5, 2)
+        a, b = random.uniform(0.03, 0.25, 2)
+        angle = random.uniform(0, np.pi)
+        value = random.choice([-120.0, 60.0, 900.0, 2400.0])
+        ellipses.append((cx, cy, a, b, angle, value))
+    for cx, cy, a, b, angle, value in ellipses:
+        u = (x - cx) * np.cos(angle) + (y - cy) * np.sin(angle)
+        v = (y - cy) * np.cos(angle) - (x - cx) * np.sin(angle)
+        image[(u / a)**2 + (v / b)**2 <= 1] += value
+    noise = random.normal(0, 20.0, (size // 8 + 1, size // 8 + 1))
+    image += np.kron(noise, np.ones((8, 8)))[:size, :size]
+    image += random.normal(0, 8.0, image.shape)
+    return np.clip(image, 0, 4095).astype(np.uint16)
+
+
+@lru_cache(maxsize=None)
+def load_image(name):
+    # gray test images, the V channel (the maximum) of the color ones,
+    # as the HSV default of the command line tool
+    if name == 'ankle':
+        image = tifffile.imread(os.path.join(DATA, 'CT-MONO2-16-ankle.tiff'))
+    elif name == 'ship1k':
+        image = imageio.imread(os.path.join(DATA, 'ship1k.png'))
+    else:
+        image = synthetic_image(int(name.split('-')[1]))
+    if image.ndim == 3:
+        image = image.max(axis=-1)
+    image.setflags(write=False)
+    return image
+
+
+def binned_image(name, bins):
+    # the image scaled to [0, bins-1], and binned as the command line
+    # tool does it
+    image = load_image(name).astype(np.float32)
+    m, M = image.min(), image.max()
+    scaled = (image - m) * (float(bins - 1) / float(M - m))
+    dtype = np.uint8 if bins < 255 else np.uint16
+    return scaled, dither(scaled, levels=bins, method='floyd', dtype=dtype)
+
+
+class MaskGeneration(object):
+    params = [[64, 256, 1024],
+              ['eucledian', 'manhattan', 'maximum', '2.3'],
+              [np.inf, 20.0]]
+    param_names = ['size', 'distance', 'R_cutoff']
+
+    def setup(self, size, distance, R_cutoff):
+        self.mask = np.zeros((size, size), dtype=np.float32)
+        self.distance = get_distance(distance)
+
+    def time_mask_generation(self, size, distance, R_cutoff):
+        mask_generation(self.mask, 1.0, ARGS['exps'], ARGS['factors'],
+                        R_cutoff=R_cutoff, distance=self.distance)
+
+
+class Conv(object):
+    params = [64, 128, 256, 512]
+    param_names = ['size']
+
+    def setup(self, size):
+        random = np.random.RandomState(0)
+        self.layer = random.rand(size, size).astype(np.float32)
+        mask = mask_generation(np.zeros((size, size), dtype=np.float32),
+                               1.0, ARGS['exps'], ARGS['factors'])
+        self.fmask = kernel_fft(mask)
+
+    def time_conv(self, size):
+        conv(self.layer, None, self.fmask)
+
+
+class Convolution(object):
+    # a batch of layers of the histogram stack
+    params = [[64, 128, 256, 512],
+              ['fft', 'dct', 'approximate']]
+    param_names = ['size', 'backend']
+
+    def setup(self, size, backend):
+        shape = (size, size)
+        random = np.random.RandomState(0)
+        self.layers = random.rand(8, size, size).astype(np.float32)
+        self.out = np.empty_like(self.layers)
+        self.fmask = kernel_spectrum(shape, 1.0, ARGS['exps'],
+                                     ARGS['factors'], backend=backend,
+                                     cache=None)
+        self.backend = backends[backend]
+
+    def time_convolution(self, size, backend):
+        self.backend(self.layers, self.fmask, out=self.out)
+
+
+class Rebin(object):
+    # all layers of the stack, as convolved_layers() regenerates them
+    params = [IMAGES, [16, 256], [4, 16]]
+    param_names = ['image', 'bins', 'downscale']
+
+    def setup(self, image, bins, downscale):
+        _, self.index = binned_image(image, bins)
+        self.pixels = np.argsort(self.index, axis=None, kind='stable')
+        counts = np.bincount(self.index.ravel())
+        self.starts = np.concatenate(([0], np.cumsum(counts)))
+        self.out = np.zeros(histogram_shape(self.index.shape, downscale),
+                            dtype=np.float32)
+
+    def time_rebin(self, image, bins, downscale):
+        for k in range(len(self.starts) - 1):
+            rebin_pixels(self.pixels[self.starts[k]:self.starts[k + 1]],
+                         self.index.shape, self.out)
+
+
+class Dither(object):
+    params = [[512, 1024, 2048, 4096],
+              ['floyd', 'parallel', 'ordered', 'blue-noise', 'basic']]
+    param_names = ['size', 'method']
+
+    def setup(self, size, method):
+        image = load_image('synthetic-{}'.format(size)).astype(np.float32)
+        self.image = image * (255. / image.max())
+
+    def time_dither(self, size, method):
+        dither(self.image, levels=256, method=method, dtype=np.uint8)
+
+
+class ToneMapping(object):
+    params = [IMAGES, [16, 256], [4, 16]]
+    param_names = ['image', 'bins', 'downscale']
+
+    def setup(self, image, bins, downscale):
+        self.img, self.binned = binned_image(image, bins)
+        shape = histogram_shape(self.img.shape, downscale)
+        layers = len(np.unique(self.binned))
+        if layers * np.prod(shape) * 4 > MAX_STACK:
+            raise NotImplementedError('the stack is too large')
+        # the kernel is computed once, as for a series of images
+        kernel_spectrum(shape, ARGS['MAX'], ARGS['exps'], ARGS['factors'])
+
+    def time_tone_mapping(self, image, bins, downscale):
+        tone_mapping(self.img, self.binned, downscale=downscale, **ARGS)
+
+
+class KernelParameters(object):
+    # the kernel is recomputed for every call
+    params = [['eucledian', 'manhattan', 'maximum', '2.3'],
+              [np.inf, 20.0]]
+    param_names = ['distance', 'R_cutoff']
+
+    def setup(self, distance, R_cutoff):
+        self.img, self.binned = binned_image('ankle', 64)
+
+    def time_tone_mapping(self, distance, R_cutoff):
+        tone_mapping(self.img, self.binned, downscale=4, R_cutoff=R_cutoff,
+                     distance_metric=distance, cache=None, **ARGS)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
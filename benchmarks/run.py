@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Runs the benchmarks of benchmarks.py without asv, and compares
+the timings with a stored baseline:
+
+    python3 -m benchmarks.run                  # compare with the baseline
+    python3 -m benchmarks.run --save           # store a new baseline
+    python3 -m benchmarks.run -b 'Dither|Conv' # only the matching ones
+
+Every benchmark is called once before the timing (for the numba
+compilation and the kernel cache), then the best of 'repeat' timings
+is taken, each of them averaged over enough calls to take at least
+'min_time'. The timings of different machines are not comparable:
+the baseline records the machine it was measured on.
+"""
+import itertools
+import json
+import os
+import platform
+import re
+import sys
+import time
+from multiprocessing import Pool
+from optparse import OptionParser
+import numpy as np
+
+from TMO4CT.tools import eprint, jit_enabled
+from . import benchmarks
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'baseline.json')
+
+
+def machine():
+    # the environment of the timings
+    try:
+        import numba
+        numba_version = numba.__version__
+    except ImportError:
+        numba_version = None
+    return {'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpus': os.cpu_count(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'numba': numba_version,
+            'jit': jit_enabled}
+
+
+def parameter_sets(cls):
+    # the combinations of the parameters, in the asv convention:
+    # a list of lists, or a single list
+    params = getattr(cls, 'params', [])
+    if not params:
+        return [()]
+    if not all(isinstance(p, list) for p in params):
+        params = [params]
+    return list(itertools.product(*params))
+
+
+def discover(pattern=None):
+    """
+    The (name, class, method, parameters) of the benchmarks,
+    in the order of benchmarks.py, whose name matches 'pattern'.
+
+    >>> [name for name, *_ in discover('Conv.time_conv')][:2]
+    ['Conv.time_conv(64)', 'Conv.time_conv(128)']
+    """
+    result = []
+    for cls in vars(benchmarks).values():
+        if not isinstance(cls, type) or cls.__module__ != benchmarks.__name__:
+            continue
+        methods = [m for m in vars(cls) if m.startswith('time_')]
+        for method, p in itertools.product(methods, parameter_sets(cls)):
+            name = '{}.{}({})'.format(cls.__name__, method,
+                                      ', '.join(str(x) for x in p))
+            if pattern is None or re.search(pattern, name):
+                result.append((name, cls, method, p))
+    return result
+
+
+def measure(f, repeat=5, min_time=0.2):
+    # the best of 'repeat' average timings of f(), in seconds
+    t = time.perf_counter()
+    f()
+    first = time.perf_counter() - t
+    number = max(1, int(min_time / max(first, 1e-9)))
+    best = np.inf
+    for _ in range(repeat):
+        t = time.perf_counter()
+        for _ in range(number):
+            f()
+        best = min(best, (time.perf_counter() - t) / number)
+    return best
+
+
+def benchmark(cls, method, p, repeat=5, min_time=0.2):
+    # the timing of a single benchmark, None if it is skipped
+    instance = cls()
+    try:
+        if hasattr(instance, 'setup'):
+            instance.setup(*p)
+    except NotImplementedError:
+        return None
+    bound = getattr(instance, method)
+    seconds = measure(lambda: bound(*p), repeat, min_time)
+    if hasattr(instance, 'teardown'):
+        instance.teardown(*p)
+    return seconds
+
+
+def run(selected, repeat=5, min_time=0.2, verbosity=0):
+    # the timings of the benchmarks, None for the skipped ones;
+    # every benchmark runs in a new process, as in asv, so the timings
+    # do not depend on the previous benchmarks (e.g. on the state of
+    # the memory allocator)
+    results = {}
+    for name, cls, method, p in selected:
+        with Pool(1) as pool:
+            results[name] = pool.apply(benchmark,
+                                       (cls, method, p, repeat, min_time))
+        if verbosity > 0:
+            if results[name] is None:
+                eprint('{:<64} skipped'.format(name))
+            else:
+                eprint('{:<64} {:10.4f} s'.format(name, results[name]))
+    return results
+
+
+def compare(results, baseline, factor=1.5):
+    """
+    The names of the benchmarks, which are slower than 'factor' times
+    their baseline, and the report of the comparison.
+
+    >>> regressions, report = compare({'a': 2.0, 'b': 1.0, 'c': None},
+    ...                               {'a': 1.0, 'b': 1.0})
+    >>> regressions
+    ['a']
+    >>> report[0].split()
+    ['a', '2.0000', 's', '1.0000', 's', '2.00', 'slower']
+    """
+    regressions = []
+    report = []
+    for name, seconds in results.items():
+        reference = baseline.get(name)
+        if seconds is None or reference is None:
+            continue
+        ratio = seconds / reference
+        mark = ''
+        if ratio > factor:
+            mark = 'slower'
+            regressions.append(name)
+        elif ratio < 1.0 / factor:
+            mark = 'faster'
+        report.append('{:<64} {:10.4f} s {:10.4f} s {:6.2f}  {}'.format(
+            name, seconds, reference, ratio, mark).rstrip())
+    return regressions, report
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-b', '--bench',
+                      dest='pattern',
+                      help='regular expression of the benchmark names',
+                      default=None)
+    parser.add_option('-B', '--baseline',
+                      dest='baseline',
+                      help='the baseline file (default: %default)',
+                      default=BASELINE)
+    parser.add_option('--save',
+                      action='store_true',
+                      dest='save',
+                      help='store the results as the baseline',
+                      default=False)
+    parser.add_option('-o', '--output',
+                      dest='output',
+                      help='store the results in this file',
+                      default=None)
+    parser.add_option('-f', '--factor',
+                      type='float',
+                      dest='factor',
+                      help='slowdown of a regression (default: %default)',
+                      default=1.5)
+    parser.add_option('-r', '--repeat',
+                      type='int',
+                      dest='repeat',
+                      help='the number of timings (default: %default)',
+                      default=5)
+    parser.add_option('--quick',
+                      action='store_true',
+                      dest='quick',
+                      help='single timings, for checking the benchmarks',
+                      default=False)
+    parser.add_option('-v', '--verbose',
+                      action='count',
+                      dest='verbose',
+                      default=0)
+    (options, args) = parser.parse_args()
+
+    selected = discover(options.pattern)
+    if not selected:
+        eprint('No benchmark matches the pattern.')
+        sys.exit(1)
+
+    if options.quick:
+        results = run(selected, repeat=1, min_time=0,
+                      verbosity=options.verbose)
+    else:
+        results = run(selected, repeat=options.repeat,
+                      verbosity=options.verbose)
+
+    data = {'machine': machine(), 'results': results}
+    if options.output is not None:
+        with open(options.output, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+
+    if options.save:
+        # the benchmarks, which were not run, keep their baseline
+        if os.path.exists(options.baseline):
+            with open(options.baseline) as f:
+                baseline = json.load(f)['results']
+            baseline.update(results)
+            data['results'] = baseline
+        with open(options.baseline, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        return
+
+    if not os.path.exists(options.baseline):
+        eprint('There is no baseline, use "--save" to store one.')
+        sys.exit(1)
+    with open(options.baseline) as f:
+        baseline = json.load(f)
+    if baseline['machine'] != data['machine']:
+        eprint('Remark: the baseline was measured in a different '
+               'environment: {}'.format(baseline['machine']))
+
+    regressions, report = compare(results, baseline['results'],
+                                  options.factor)
+    print('\n'.join(report))
+    if regressions:
+        eprint('{} benchmark(s) are more than {} times slower than the '
+               'baseline'.format(len(regressions), options.factor))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -34,7 +34,7 @@ setup(
     include_package_data=True,
     keywords=['tonemapping', 'CT'],
     name='TMO4CT',
-    packages=find_packages(where='.'),
+    packages=find_packages(where='.', exclude=['benchmarks']),
     scripts=['TMO4CT_cli.py'],
     setup_requires=setup_requirements,
     test_suite='tests',